@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import filecmp
+import contextlib
+import tempfile
+import argparse
+import numpy as np
+import pandas as pd
+from prompt_building import VllmTemplate, templates, model_formats
+from output_parser import extract_number, extract_scores, score_patterns, compute_correlation_score, read_tsv
+from output_store import read_outputs
+from run import run_chunked
+from score_decoding import load_logprobs, expected_score
+from sweep import FakeBackend
+from instrumentation import metrics, stage
+
+
+language_pairs = ["en-de", "en-mr", "en-zh", "et-en", "ne-en", "ro-en", "ru-en", "si-en"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark prompt building and check it against the shipped prompts")
+    parser.add_argument("--raw_data", type=str, default="./raw_data/", help="The folder containing the raw data of each language pair")
+    parser.add_argument("--prompt_dir", type=str, default="./prompts/", help="The folder containing the shipped prompts of each model")
+    parser.add_argument("--outputs_dir", type=str, default="./llm_output_samples/", help="The folder containing LLM output files for the score extraction benchmark")
+    parser.add_argument("--benchmarks", type=str, nargs="+", default=["prompts", "shipped", "scores", "logprobs", "pipeline", "resume"], help="The benchmarks and checks to run: prompts, shipped, scores, logprobs, pipeline, resume")
+    parser.add_argument("--repeat", type=int, default=3, help="The number of times each timing is repeated, the best one is reported")
+    parser.add_argument("--metrics_file", type=str, default=None, help="Save the stage metrics of the pipeline benchmark to this JSON file, e.g. as a baseline")
+    parser.add_argument("--baseline", type=str, default=None, help="A metrics file of an earlier pipeline benchmark, stages that got slower than it by more than --tolerance fail")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="The slowdown in rows/sec allowed against the baseline")
+    args = parser.parse_args()
+    return args
+
+
+def best_time(func, repeat):
+    '''the best wall time of func over repeat runs and its last result'''
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def rowwise_prompts(template, name):
+    '''The row-by-row loop VllmTemplate used before the batched engine, kept as the baseline.'''
+    text, fields = templates[name]
+    static = template.static_fields()
+    instruction_list = []
+    for i in range(len(template.main_file)):
+        values = []
+        for field in fields:
+            if field in static:
+                values.append(static[field])
+            elif field == "error_words":
+                values.append(template.main_file["error_words"][i] if isinstance(template.main_file["error_words"][i], str) else "")
+            elif field == "prompt1_output":
+                values.append(template.prompt1_output[i])
+            else:
+                values.append(template.main_file[field][i])
+        instruction = template.format.format(user_input=text % tuple(values))
+        instruction_list.append(instruction)
+    return instruction_list
+
+
+def bench_prompt_building(raw_data, repeat):
+    '''time the row-by-row loop against the batched engine for every template of every language pair'''
+    print("%-8s %-9s %6s %12s %12s %8s" % ("pair", "format", "rows", "rowwise (s)", "batched (s)", "speedup"))
+    for lang_pair in language_pairs:
+        main_file = os.path.join(raw_data, lang_pair, lang_pair + "_overlaps_test.tsv")
+        for model, format in model_formats.items():
+            template = VllmTemplate(main_file, format=format)
+            names = template.available_templates()
+
+            def batched():
+                template._columns = None
+                return template.generate_templates(names, save=False)
+
+            rowwise_time, rowwise = best_time(lambda: {name: rowwise_prompts(template, name) for name in names}, repeat)
+            batched_time, batched = best_time(batched, repeat)
+            if rowwise != batched:
+                raise AssertionError("Batched prompts differ from row-by-row prompts for %s %s" % (lang_pair, model))
+            print("%-8s %-9s %6d %12.4f %12.4f %7.1fx" % (lang_pair, model, len(template.main_file), rowwise_time, batched_time, rowwise_time / batched_time))
+
+
+def check_shipped_prompts(raw_data, prompt_dir):
+    '''regenerate the shipped prompts/<model>/<pair>_vllm_t<name>.tsv files and compare them byte by byte'''
+    checked, mismatched = 0, []
+    with tempfile.TemporaryDirectory() as output_dir:
+        for model, format in model_formats.items():
+            for lang_pair in language_pairs:
+                prefix = lang_pair + "_vllm_t"
+                shipped = sorted(f[len(prefix):-len(".tsv")] for f in os.listdir(os.path.join(prompt_dir, model)) if f.startswith(prefix) and f.endswith(".tsv"))
+                # the second CoT prompt depends on the model outputs of the first one
+                names = [name for name in shipped if name != "7p2"]
+                if not names:
+                    continue
+                template = VllmTemplate(os.path.join(raw_data, lang_pair, lang_pair + "_overlaps_test.tsv"), format=format)
+                template.generate_templates(names, output_dir=output_dir)
+                for name in names:
+                    checked += 1
+                    if not filecmp.cmp(os.path.join(output_dir, prefix + name + ".tsv"), os.path.join(prompt_dir, model, prefix + name + ".tsv"), shallow=False):
+                        mismatched.append(os.path.join(model, prefix + name + ".tsv"))
+    print("Checked %d shipped prompt files, %d mismatched." % (checked, len(mismatched)))
+    for path in mismatched:
+        print("  mismatch: %s" % path)
+    return mismatched
+
+
+def bench_score_extraction(outputs_dir, repeat, copies=10):
+    '''time extract_number against extract_scores on every output file in outputs_dir, repeated copies times'''
+    outputs = [read_outputs(os.path.join(outputs_dir, f))["vllm_output"] for f in sorted(os.listdir(outputs_dir)) if f.endswith(".tsv") or f.endswith(".parquet")]
+    data = pd.DataFrame({"vllm_output": pd.concat(outputs * copies, ignore_index=True)})
+
+    loop_time, (num, dropped_index) = best_time(lambda: extract_number(data, key="vllm_output", position=0), repeat)
+    print("%-16s %9d rows %10.4f s %12.0f rows/s" % ("extract_number", len(data), loop_time, len(data) / loop_time))
+    for strategy in score_patterns:
+        batched_time, (scores, valid) = best_time(lambda: extract_scores(data, key="vllm_output", strategy=strategy), repeat)
+        print("%-16s %9d rows %10.4f s %12.0f rows/s  %5.1fx  valid %.1f%%" % ("scores:" + strategy, len(data), batched_time, len(data) / batched_time, loop_time / batched_time, 100 * valid.mean()))
+        if strategy == "first" and (not np.array_equal(scores[valid], num) or np.flatnonzero(~valid).tolist() != dropped_index):
+            raise AssertionError("extract_scores(strategy='first') differs from extract_number")
+
+
+def check_expected_scores(fixture_file):
+    '''compare expected_score on each record of a .logprobs.jsonl fixture to its "expected" score, null for no score'''
+    records, failed = load_logprobs(fixture_file), []
+    for record in records:
+        score = expected_score(record)
+        expected = float("nan") if record["expected"] is None else record["expected"]
+        if not (np.isnan(score) and np.isnan(expected)) and not np.isclose(score, expected):
+            failed.append("%s: %s instead of %s" % (record["case"], score, expected))
+    print("Checked %d expected scores, %d wrong." % (len(records), len(failed)))
+    if failed:
+        raise AssertionError("\n".join(failed))
+
+
+def check_resume(raw_data, lang_pair="en-zh", name="01", chunk_size=64):
+    '''
+    Crash a stub run after a few chunks, tear the last line of its partial file at every byte, as a crash in the middle of a write would,
+    and check that each resumed run writes the same output file as an uninterrupted run.
+    The stub answers with non-ASCII text so that some cuts fall inside a multi-byte character.
+    '''
+    template = VllmTemplate(os.path.join(raw_data, lang_pair, lang_pair + "_overlaps_test.tsv"), format=model_formats["llama"])
+    prompts = template.generate_templates([name], save=False)[name]
+    answer = lambda batch: ["分数: %d" % (len(prompt) % 101) for prompt in batch]
+
+    def crash_after(chunks):
+        calls = []
+
+        def generate(batch):
+            calls.append(len(batch))
+            if len(calls) > chunks:
+                raise RuntimeError("crash")
+            return answer(batch)
+        return generate
+
+    failed = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        expected_file = os.path.join(output_dir, "expected.tsv")
+        run_chunked(prompts, answer, expected_file, chunk_size=chunk_size)
+        with open(expected_file, "rb") as f:
+            expected = f.read()
+        output_file = os.path.join(output_dir, "resumed.tsv")
+        try:
+            run_chunked(prompts, crash_after(3), output_file, chunk_size=chunk_size, settings={"seed": 0})
+        except RuntimeError:
+            pass
+        with open(output_file + ".partial", "rb") as f:
+            partial = f.read()
+        last_line = partial.rfind(b"\n", 0, len(partial) - 1) + 1
+        header_end = partial.find(b"\n") + 1
+        # cuts inside the last row, and inside the header of a file with no row yet
+        cuts = list(range(last_line, len(partial))) + list(range(0, header_end, 7))
+        with contextlib.redirect_stdout(None):
+            for cut in cuts:
+                with open(output_file + ".partial", "wb") as f:
+                    f.write(partial[:cut])
+                run_chunked(prompts, answer, output_file, chunk_size=chunk_size, settings={"seed": 0})
+                with open(output_file, "rb") as f:
+                    if f.read() != expected:
+                        failed.append(cut)
+    print("Resumed %d torn partial files, %d differ from an uninterrupted run." % (len(cuts), len(failed)))
+    if failed:
+        raise AssertionError("Resuming from partial files cut at bytes %s gives other outputs" % failed)
+
+
+def run_pipeline(raw_data, names, output_format):
+    '''one run of the pipeline stages on every language pair, recorded in metrics'''
+    generate = lambda prompts: FakeBackend().generate(prompts)[0]
+    metrics.reset()
+    with tempfile.TemporaryDirectory() as output_dir:
+        for lang_pair in language_pairs:
+            main_file = os.path.join(raw_data, lang_pair, lang_pair + "_overlaps_test.tsv")
+            template = VllmTemplate(main_file, format=model_formats["llama"])
+            prompts = template.generate_templates([name for name in names if name in template.available_templates()], save=False)
+            label = list(map(round, read_tsv(main_file)["score"].tolist()))
+            for name, template_prompts in prompts.items():
+                output_file = os.path.join(output_dir, "%s_outputs_t%s-stub.%s" % (lang_pair.upper(), name, output_format))
+                run_chunked(template_prompts, generate, output_file, chunk_size=512)
+                with stage("read_outputs", rows=len(template_prompts)):
+                    data = read_outputs(output_file)
+                num, dropped_index = extract_number(data, key="vllm_output", position=0)
+                with contextlib.redirect_stdout(None):
+                    compute_correlation_score(num, label, dropped_index)
+    return metrics.report()
+
+
+def bench_pipeline(raw_data, repeat, names=("01", "03", "04", "08"), output_format="tsv"):
+    '''
+    Run every CPU-side stage of the pipeline on the bundled raw data with a stub generator instead of a model:
+    prompt rendering, chunked generation, writing and reading the outputs, score extraction and correlation with the gold labels.
+    The stub answers each prompt with a score derived from its hash, so every run processes the same data.
+    Returns the report of the pipeline with the best time of each stage over repeat runs.
+    '''
+    reports = [run_pipeline(raw_data, names, output_format) for _ in range(repeat)]
+    report = dict(reports[-1], wall_time=min(r["wall_time"] for r in reports), peak_rss_mb=max(r["peak_rss_mb"] or 0 for r in reports) or None,
+                  stages={name: min((r["stages"][name] for r in reports), key=lambda timing: timing["seconds"]) for name in reports[-1]["stages"]})
+    print("%-16s %6s %9s %10s %12s" % ("stage", "calls", "rows", "seconds", "rows/s"))
+    for name, timing in report["stages"].items():
+        print("%-16s %6d %9d %10.4f %12.0f" % (name, timing["calls"], timing["rows"], timing["seconds"], timing["rows_per_sec"] or 0))
+    print("Wall time %.2fs, peak RSS %s MB" % (report["wall_time"], report["peak_rss_mb"]))
+    return report
+
+
+def compare_to_baseline(report, baseline_file, tolerance=0.25):
+    '''the stages whose rows/sec dropped by more than tolerance against a saved report'''
+    with open(baseline_file, "r", encoding="utf-8") as f:
+        baseline = json.load(f)["stages"]
+    regressions = []
+    for name, timing in report["stages"].items():
+        if name in baseline and timing["rows_per_sec"] and baseline[name]["rows_per_sec"]:
+            ratio = timing["rows_per_sec"] / baseline[name]["rows_per_sec"]
+            print("%-16s %8.2fx of baseline%s" % (name, ratio, "  REGRESSION" if ratio < 1 - tolerance else ""))
+            if ratio < 1 - tolerance:
+                regressions.append(name)
+    return regressions
+
+
+def main():
+    args = parse_args()
+    if "prompts" in args.benchmarks:
+        bench_prompt_building(args.raw_data, args.repeat)
+    if "shipped" in args.benchmarks:
+        check_shipped_prompts(args.raw_data, args.prompt_dir)
+    if "scores" in args.benchmarks:
+        bench_score_extraction(args.outputs_dir, args.repeat)
+    if "logprobs" in args.benchmarks:
+        check_expected_scores(os.path.join(args.outputs_dir, "score_decoding_cases.logprobs.jsonl"))
+    if "resume" in args.benchmarks:
+        check_resume(args.raw_data)
+    if "pipeline" in args.benchmarks:
+        report = bench_pipeline(args.raw_data, args.repeat)
+        if args.metrics_file:
+            with open(args.metrics_file, "w", encoding="utf-8") as f:
+                json.dump({"benchmark": "pipeline", **report}, f, indent=2)
+        if args.baseline and compare_to_baseline(report, args.baseline, args.tolerance):
+            raise SystemExit("The pipeline got slower than the baseline %s" % args.baseline)
+
+
+if __name__ == "__main__":
+    main()
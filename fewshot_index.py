@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from preflight import file_hash
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build the nearest-neighbour few-shot example index of each language pair")
+    parser.add_argument("--lang_pairs", type=str, nargs="+", default=["en-de", "en-mr", "en-zh", "et-en", "ne-en", "ro-en", "ru-en", "si-en"], help="The language pairs to index")
+    parser.add_argument("--raw_data", type=str, default="./raw_data/", help="The folder of the raw data")
+    parser.add_argument("--cache_dir", type=str, default="./.cache/fewshot/", help="The folder to save the indices")
+    parser.add_argument("--k", type=int, default=5, help="The number of examples retrieved for each test row when timing the queries")
+    args = parser.parse_args()
+    return args
+
+
+def char_ngrams(text, ngram_range=(2, 4)):
+    '''the character n-grams of a lowercased text, padded with a space on both sides'''
+    text = " " + " ".join(str(text).lower().split()) + " "
+    return [text[i:i + n] for n in range(ngram_range[0], ngram_range[1] + 1) for i in range(len(text) - n + 1)]
+
+
+def count_matrix(texts, vocabulary, ngram_range=(2, 4), grow=False):
+    '''
+    The n-gram counts of the texts as a sparse matrix over vocabulary (a dict of n-gram -> column).
+    grow: add unseen n-grams to vocabulary, otherwise they are ignored
+    '''
+    indices, indptr = [], [0]
+    for text in texts:
+        for ngram in char_ngrams(text, ngram_range):
+            column = vocabulary.get(ngram)
+            if column is None and grow:
+                column = vocabulary[ngram] = len(vocabulary)
+            if column is not None:
+                indices.append(column)
+        indptr.append(len(indices))
+    matrix = sp.csr_matrix((np.ones(len(indices), dtype=np.float32), np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int64)), shape=(len(texts), len(vocabulary)))
+    # duplicate n-grams of a row are summed into their count
+    matrix.sum_duplicates()
+    return matrix
+
+
+def tfidf(counts, idf):
+    '''sublinear tf x idf, with every row L2-normalised so that a dot product is the cosine similarity'''
+    matrix = counts.copy()
+    matrix.data = (1 + np.log(matrix.data)) * idf[matrix.indices]
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sp.csr_matrix(sp.diags(1 / norms) @ matrix, dtype=np.float32)
+
+
+class FewShotIndex:
+    '''
+    A character n-gram TF-IDF index of the scored examples of a language pair, to retrieve the examples most similar to each test row.
+    examples: a dataframe with src, mt, ref and score, e.g. a train split
+    field: the column the similarity is computed on
+    '''
+    def __init__(self, examples, field="src", ngram_range=(2, 4)) -> None:
+        self.examples = examples.reset_index(drop=True)
+        self.field = field
+        self.ngram_range = tuple(ngram_range)
+        self.vocabulary = {}
+        counts = count_matrix(self.examples[field].tolist(), self.vocabulary, self.ngram_range, grow=True)
+        document_frequency = np.bincount(counts.indices, minlength=counts.shape[1])
+        self.idf = (np.log((1 + counts.shape[0]) / (1 + document_frequency)) + 1).astype(np.float32)
+        self.matrix = tfidf(counts, self.idf)
+
+    def transposed(self):
+        '''the examples as columns in CSR, transposed once rather than on every query batch'''
+        if getattr(self, "_transposed", None) is None:
+            self._transposed = self.matrix.T.tocsr()
+        return self._transposed
+
+    def vectorize(self, texts):
+        return tfidf(count_matrix(texts, self.vocabulary, self.ngram_range), self.idf)
+
+    def query(self, texts, k=5, batch_size=1024, exclude_identical=True):
+        '''
+        The k most similar examples of each text, most similar first, as two arrays of shape (texts, k):
+        the example rows and their cosine similarities. The texts are queried in batches of one sparse matrix product each.
+        exclude_identical: skip examples whose text is the query itself, e.g. a test sentence that is also in the train split
+        '''
+        texts = [str(text) for text in texts]
+        k = min(k, self.matrix.shape[0])
+        rows = np.empty((len(texts), k), dtype=np.int64)
+        similarities = np.empty((len(texts), k), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            scores = (self.vectorize(texts[start:start + batch_size]) @ self.transposed()).toarray()
+            if exclude_identical:
+                scores[scores > 1 - 1e-5] = -1
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind="stable")
+            rows[start:start + len(top)] = np.take_along_axis(top, order, axis=1)
+            similarities[start:start + len(top)] = np.take_along_axis(top_scores, order, axis=1)
+        return rows, similarities
+
+    def format_examples(self, rows):
+        '''
+        The few-shot block of each query in the format of few_shot_examples, from the rows returned by query.
+        As in the hand-picked examples, the examples of a block are sorted by score.
+        '''
+        src, mt, ref = (self.examples[field].astype(str).str.strip().to_numpy() for field in ("src", "mt", "ref"))
+        scores = self.examples["score"].round().astype(int).to_numpy()
+        blocks = []
+        for query_rows in rows:
+            query_rows = query_rows[np.argsort(scores[query_rows], kind="stable")]
+            blocks.append("\n\n".join("Example %d\nSource: %s\nMachine translation: %s\nReference translation: %s\nScore: %d" % (n + 1, src[i], mt[i], ref[i], scores[i]) for n, i in enumerate(query_rows)))
+        return blocks
+
+    def save(self, file_name):
+        vocabulary = np.empty(len(self.vocabulary), dtype=object)
+        vocabulary[list(self.vocabulary.values())] = list(self.vocabulary)
+        np.savez_compressed(file_name, data=self.matrix.data, indices=self.matrix.indices, indptr=self.matrix.indptr, shape=self.matrix.shape,
+                            idf=self.idf, vocabulary=vocabulary.astype(str), field=self.field, ngram_range=self.ngram_range)
+
+    @classmethod
+    def load(cls, file_name, examples):
+        '''load an index saved by save, examples: the dataframe it was built from'''
+        index = cls.__new__(cls)
+        with np.load(file_name) as f:
+            index.matrix = sp.csr_matrix((f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"]))
+            index.idf = f["idf"]
+            index.vocabulary = {ngram: column for column, ngram in enumerate(f["vocabulary"].tolist())}
+            index.field = str(f["field"])
+            index.ngram_range = tuple(f["ngram_range"].tolist())
+        index.examples = examples.reset_index(drop=True)
+        return index
+
+
+def example_file(lang_pair_short, raw_data="./raw_data/"):
+    '''the split the examples of a language pair come from: train, or dev for the pairs without a train split'''
+    for split in ("train", "dev"):
+        file_name = os.path.join(raw_data, lang_pair_short, lang_pair_short + "_overlaps_" + split + ".tsv")
+        if os.path.exists(file_name):
+            return file_name
+    raise FileNotFoundError("No train or dev split for %s!" % lang_pair_short)
+
+
+def load_index(lang_pair_short, raw_data="./raw_data/", cache_dir="./.cache/fewshot/", field="src", ngram_range=(2, 4)):
+    '''the index of a language pair, built once and cached in cache_dir per example file content, field and n-gram range'''
+    examples_file = example_file(lang_pair_short, raw_data)
+    examples = pd.read_csv(examples_file, sep="\t", encoding="utf-8")
+    cache_file = os.path.join(cache_dir, "%s_%s_%d-%d_%s.npz" % (lang_pair_short, field, ngram_range[0], ngram_range[1], file_hash(examples_file)[:16]))
+    if os.path.exists(cache_file):
+        return FewShotIndex.load(cache_file, examples)
+    index = FewShotIndex(examples, field=field, ngram_range=ngram_range)
+    os.makedirs(cache_dir, exist_ok=True)
+    index.save(cache_file)
+    return index
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    for lang_pair in args.lang_pairs:
+        begin = time.perf_counter()
+        index = load_index(lang_pair, args.raw_data, args.cache_dir)
+        loaded = time.perf_counter() - begin
+        test = pd.read_csv(os.path.join(args.raw_data, lang_pair, lang_pair + "_overlaps_test.tsv"), sep="\t", encoding="utf-8")
+        begin = time.perf_counter()
+        rows, similarities = index.query(test["src"].tolist(), k=args.k)
+        print("%s: %d examples, %d n-grams, loaded in %.2fs, top-%d of %d test rows in %.2fs, mean similarity %.3f"
+              % (lang_pair, index.matrix.shape[0], index.matrix.shape[1], loaded, args.k, len(test), time.perf_counter() - begin, similarities.mean()))
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import time
+import functools
+import contextlib
+
+
+class Metrics:
+    '''
+    The timings and counters of one run: the wall time, calls and rows of each pipeline stage, counters such as
+    prompt_tokens and completion_tokens, and the peak resident memory of the process.
+    '''
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=0):
+        '''time the block as one call of the stage name, processing rows rows'''
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "rows": 0})
+            stage["calls"] += 1
+            stage["seconds"] += time.perf_counter() - begin
+            stage["rows"] += int(rows)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def report(self):
+        '''the stages with their rows/sec, the counters, the wall time since the last reset and the peak RSS in MB'''
+        return {
+            "wall_time": round(time.perf_counter() - self.start, 4),
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": {name: {**stage, "seconds": round(stage["seconds"], 4), "rows_per_sec": round(stage["rows"] / stage["seconds"], 1) if stage["seconds"] and stage["rows"] else None}
+                       for name, stage in self.stages.items()},
+            "counters": dict(self.counters),
+        }
+
+    def save(self, file_name, **info):
+        '''export the report, with info such as the model and template of the run, to a JSON file'''
+        with open(file_name, "w", encoding="utf-8") as f:
+            json.dump({**info, **self.report()}, f, indent=2)
+        return file_name
+
+
+def peak_rss_mb():
+    '''the peak resident memory of the process in MB, None where the resource module is missing (Windows)'''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB on Linux
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+'''the metrics of the current run, shared by the pipeline stages'''
+metrics = Metrics()
+stage = metrics.stage
+count = metrics.count
+
+
+def timed(name, rows=None):
+    '''record every call of the decorated function as the stage name, rows: a function of the call's arguments giving its number of rows'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.stage(name, rows(*args, **kwargs) if rows else 0):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
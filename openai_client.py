@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import random
+import asyncio
+import argparse
+import pandas as pd
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export prompt files to JSONL batch requests, run them against an OpenAI-compatible server, and import the results")
+    parser.add_argument("--export", type=str, nargs="+", default=None, help="The prompt files to export as batch requests")
+    parser.add_argument("--run_batch", type=str, default=None, help="A batch request file to send to --base_url, the results are written to --batch_output")
+    parser.add_argument("--import_batch", type=str, default=None, help="A batch result file to write back as one output file per prompt file")
+    parser.add_argument("--batch_file", type=str, default="batch_requests.jsonl", help="The batch request file written by --export")
+    parser.add_argument("--batch_output", type=str, default="batch_results.jsonl", help="The batch result file written by --run_batch")
+    parser.add_argument("--model_name", type=str, default="meta-llama/Llama-2-7b-chat-hf", help="The model name the server serves")
+    parser.add_argument("--base_url", type=str, default="http://localhost:8000/v1", help="The OpenAI-compatible endpoint, e.g. of vllm serve")
+    parser.add_argument("--max_in_flight", type=int, default=64, help="The maximum number of requests waiting for the server at once")
+    parser.add_argument("--output_dir", type=str, default=".", help="The folder to write the outputs imported from a batch result file")
+    parser.add_argument("--output_format", type=str, default="tsv", choices=["tsv", "parquet"])
+    parser.add_argument("--max_tokens", type=int, default=512)
+    parser.add_argument("--temperature", type=float, default=0.8)
+    parser.add_argument("--top_p", type=float, default=0.95)
+    args = parser.parse_args()
+    return args
+
+
+class OpenAIBackend:
+    '''
+    Sends the prompts to an OpenAI-compatible completions endpoint (e.g. vllm serve) with asyncio, so that many
+    evaluation jobs can share one long-running server instead of each loading the model. Same interface as the backends of sweep.py.
+    base_url: the endpoint, e.g. http://localhost:8000/v1
+    max_in_flight: the number of requests waiting for the server at once, which is also the size of the connection pool
+    batch_size: the number of prompts sent in one request, the server returns one choice per prompt. The server batches concurrent
+    requests anyway, and only with one prompt per request are the generated tokens of each prompt measured rather than estimated
+    max_retries, backoff: a failed request (connection error, timeout, 429 or 5xx) is retried after backoff x 2^attempt seconds, with jitter
+    sampling: the sampling params of the requests, e.g. with stop sequences, instead of temperature, top_p and max_tokens
+    '''
+    def __init__(self, base_url="http://localhost:8000/v1", api_key=None, max_in_flight=64, batch_size=1, max_retries=5, backoff=1.0, timeout=600,
+                 temperature=0.8, top_p=0.95, max_tokens=512, seed=None, sampling=None, **kwargs) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key if api_key else os.environ.get("OPENAI_API_KEY", "EMPTY")
+        self.max_in_flight = max_in_flight
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.sampling = dict(sampling) if sampling else {"temperature": temperature, "top_p": top_p, "max_tokens": max_tokens}
+        if seed is not None:
+            self.sampling["seed"] = seed
+        self.model_name = None
+
+    def load(self, model_name, quantization=None):
+        '''the model is loaded by the server, quantization is set there'''
+        self.model_name = model_name
+
+    def unload(self):
+        self.model_name = None
+
+    async def post(self, session, semaphore, body):
+        '''POST one request, retrying with exponential backoff'''
+        import aiohttp
+        for attempt in range(self.max_retries + 1):
+            async with semaphore:
+                try:
+                    async with session.post(self.base_url + "/completions", json=body) as response:
+                        if response.status == 200:
+                            return await response.json()
+                        error = "HTTP %d: %s" % (response.status, (await response.text())[:200])
+                        if response.status != 429 and response.status < 500:
+                            raise RuntimeError(error)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    error = repr(e)
+            if attempt < self.max_retries:
+                await asyncio.sleep(self.backoff * 2 ** attempt * (0.5 + random.random()))
+        raise RuntimeError("Request failed after %d retries: %s" % (self.max_retries, error))
+
+    async def complete(self, session, semaphore, prompts, sampling):
+        '''
+        The text, generated tokens and error of each prompt of one request. If the request fails, its prompts are sent again
+        one per request, so that a prompt the server rejects (e.g. one longer than its context) only fails on its own.
+        '''
+        try:
+            response = await self.post(session, semaphore, {"model": self.model_name, "prompt": prompts, **sampling})
+        except RuntimeError as e:
+            if len(prompts) == 1:
+                return [("", 0, str(e))]
+            results = await asyncio.gather(*[self.complete(session, semaphore, [prompt], sampling) for prompt in prompts])
+            return [result[0] for result in results]
+        texts, tokens = completion_texts(response, len(prompts))
+        return [(text, n, None) for text, n in zip(texts, tokens)]
+
+    async def acomplete(self, prompts, sampling=None, batch_size=None):
+        '''the text, generated tokens and error (None if it succeeded) of each prompt, in the order of the prompts'''
+        import aiohttp
+        sampling = sampling if sampling else self.sampling
+        batch_size = batch_size if batch_size else self.batch_size
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+        headers = {"Authorization": "Bearer " + self.api_key}
+        batches = [prompts[start:start + batch_size] for start in range(0, len(prompts), batch_size)]
+        async with aiohttp.ClientSession(connector=connector, headers=headers, timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+            results = await asyncio.gather(*[self.complete(session, semaphore, batch, sampling) for batch in batches])
+        return [result for batch_results in results for result in batch_results]
+
+    async def agenerate(self, prompts, sampling=None):
+        '''
+        The generated text and the number of generated tokens of each prompt, in the order of the prompts.
+        Raises a RuntimeError if any prompt failed, rather than returning an empty text that would be cached and saved as its output.
+        '''
+        results = await self.acomplete(prompts, sampling)
+        errors = [error for _, _, error in results if error]
+        if errors:
+            raise RuntimeError("%d of %d prompts failed, e.g. %s" % (len(errors), len(prompts), errors[0]))
+        return [text for text, _, _ in results], [n for _, n, _ in results]
+
+    def generate(self, prompts):
+        return asyncio.run(self.agenerate(list(prompts)))
+
+
+def completion_texts(response, n_prompts):
+    '''
+    The texts of a completions response in prompt order, as its choices may come back in any order,
+    and the generated tokens of each. The usage of a response is only known for all its prompts together, so with several prompts
+    it is an estimate, shared in proportion to the text lengths.
+    '''
+    texts = [""] * n_prompts
+    for choice in response["choices"]:
+        texts[choice["index"]] = choice["text"]
+    total = (response.get("usage") or {}).get("completion_tokens", 0)
+    length = sum(len(text) for text in texts)
+    tokens = [round(total * len(text) / length) if length else 0 for text in texts]
+    return texts, tokens
+
+
+def custom_id(prompt_file, row):
+    return "%s:%d" % (prompt_file, row)
+
+
+def export_batch(prompt_files, batch_file, model_name, sampling):
+    '''
+    Write the prompts of the prompt files as one JSONL batch request file, one completions request per prompt with custom_id <prompt file>:<row>,
+    the input format of the OpenAI batch API and of vLLM's run_batch entrypoint.
+    '''
+    with open(batch_file, "w", encoding="utf-8") as f:
+        for prompt_file in prompt_files:
+            prompts = pd.read_csv(prompt_file, sep="\t", encoding="utf-8")["final_prompt"].tolist()
+            f.write("".join(json.dumps({"custom_id": custom_id(prompt_file, row), "method": "POST", "url": "/v1/completions",
+                                        "body": {"model": model_name, "prompt": prompt, **sampling}}, ensure_ascii=False) + "\n" for row, prompt in enumerate(prompts)))
+    return batch_file
+
+
+def run_batch(batch_file, batch_output, backend, chunk_size=4096):
+    '''
+    Send the requests of a batch request file to the backend's server and write the results in the batch API output format.
+    The requests are sent chunk by chunk, so a batch file of any size is streamed instead of held in memory at once.
+    Each request is sent on its own so that its usage is exact, and a request that fails gets an error record instead of stopping the batch.
+    '''
+    def flush(requests, f):
+        if not requests:
+            return
+        sampling = {key: value for key, value in requests[0]["body"].items() if key not in ("model", "prompt")}
+        backend.load(requests[0]["body"]["model"])
+        results = asyncio.run(backend.acomplete([request["body"]["prompt"] for request in requests], sampling, batch_size=1))
+        f.write("".join(json.dumps({"custom_id": request["custom_id"], "response": {"status_code": 200, "body": {"choices": [{"index": 0, "text": text}], "usage": {"completion_tokens": n}}}, "error": None}
+                                   if error is None else {"custom_id": request["custom_id"], "response": None, "error": {"message": error}}, ensure_ascii=False) + "\n"
+                        for request, (text, n, error) in zip(requests, results)))
+        failed = sum(error is not None for _, _, error in results)
+        if failed:
+            print("%d of %d requests failed, see the error of their records." % (failed, len(requests)))
+
+    with open(batch_file, "r", encoding="utf-8") as f_in, open(batch_output, "w", encoding="utf-8") as f_out:
+        requests = []
+        for line in f_in:
+            request = json.loads(line)
+            # one generate call per run of requests with the same model and sampling params
+            if (requests and {**request["body"], "prompt": None} != {**requests[0]["body"], "prompt": None}) or len(requests) == chunk_size:
+                flush(requests, f_out)
+                requests = []
+            requests.append(request)
+        flush(requests, f_out)
+    return batch_output
+
+
+def import_batch(batch_output):
+    '''
+    Read a batch result file back as a dict of prompt file -> (generated texts, completion tokens) in row order.
+    A request that failed or is missing from the results is left empty.
+    '''
+    results = {}
+    with open(batch_output, "r", encoding="utf-8") as f:
+        for line in f:
+            result = json.loads(line)
+            prompt_file, _, row = result["custom_id"].rpartition(":")
+            rows = results.setdefault(prompt_file, {})
+            response = result.get("response") or {}
+            if response.get("status_code") == 200:
+                texts, tokens = completion_texts(response["body"], 1)
+                rows[int(row)] = (texts[0], tokens[0])
+            else:
+                print("%s failed: %s" % (result["custom_id"], result.get("error")))
+    imported = {}
+    for prompt_file, rows in results.items():
+        n_rows = len(pd.read_csv(prompt_file, sep="\t", encoding="utf-8")) if os.path.exists(prompt_file) else max(rows, default=-1) + 1
+        imported[prompt_file] = ([rows[row][0] if row in rows else "" for row in range(n_rows)], [rows[row][1] if row in rows else 0 for row in range(n_rows)])
+    return imported
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    sampling = {"temperature": args.temperature, "top_p": args.top_p, "max_tokens": args.max_tokens}
+    if args.export:
+        print("Exported %s" % export_batch(args.export, args.batch_file, args.model_name, sampling))
+    if args.run_batch:
+        backend = OpenAIBackend(args.base_url, max_in_flight=args.max_in_flight)
+        print("Results in %s" % run_batch(args.run_batch, args.batch_output, backend))
+    if args.import_batch:
+        from run import output_file_name, write_outputs
+        for prompt_file, (texts, tokens) in import_batch(args.import_batch).items():
+            lang_pair, template = os.path.basename(prompt_file)[:-len(".tsv")].split("_vllm_t")
+            prompts = pd.read_csv(prompt_file, sep="\t", encoding="utf-8")["final_prompt"].tolist()
+            output_file = os.path.join(args.output_dir, output_file_name(lang_pair, template, args.model_name, args.output_format))
+            write_outputs(output_file, prompts, texts, prompt_file=prompt_file, metadata={"model_name": args.model_name, "template": template, "lang_pair": lang_pair}, completion_tokens=tokens)
+            print("%s -> %s" % (prompt_file, output_file))
@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import os
 import json
 import re
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 from scipy.stats import spearmanr, pearsonr, kendalltau
 import pandas as pd
+from output_store import read_outputs
+from preflight import file_hash
+from instrumentation import timed
 
 
 def read_jsonl(file_name):
@@ -41,6 +49,7 @@ def extract_num_from_str(pattern, prediction_str, prediction_idx, num_position,
     except IndexError:
         index.append(prediction_idx)
 
+@timed("extract_number", rows=lambda data, *args, **kwargs: len(data))
 def extract_number(data, key="predict", position=0):
     result = []
     index = [] # record the index of predictions that do not have a number
@@ -63,42 +72,337 @@ def extract_number(data, key="predict", position=0):
     return result, index
 
 
-def compute_correlation_score(num, label, dropped_index=None):
+number_pattern = r"[-+]?\d*\.\d+|[-+]?\d+"
+
+'''the regex of each score extraction strategy, its first group is the score'''
+score_patterns = {
+    # the first number, as in extract_number
+    "first": "(%s)" % number_pattern,
+    # the last number, e.g. after an explanation; the dash of a range such as 90-97 is not read as a minus,
+    # but the sign of a number such as -5 is not dropped either
+    "last": r"^.*(?:(?<![\d.])|(?<!\d)(?=\.\d))(?<!^[-+])(?<![^\d][-+])(%s)" % number_pattern,
+    # the number right after "Score:", "**Score:**", "Score (0-100):" or "score": in JSON, the range echoed from the prompt is skipped
+    "anchored": r"(?i)score\s*(?:\([^)]*\))?\s*[\"*]*\s*[:=][\s\"*]*(%s)" % number_pattern,
+    # a fraction such as 85/100 or 4.5/5, rescaled to 0-100; not part of a date such as 12/05/2020
+    "fraction": r"(?<![\d./])(%s)\s*/\s*(\d*\.\d+|\d+)(?![\d.]*\s*/)" % number_pattern,
+    # the first number, clipped to 0-100
+    "clamped": "(%s)" % number_pattern,
+}
+
+
+def to_series(data, key="predict"):
+    '''the predictions as a pandas Series, from a dataframe column, a list of dictionaries or a list of strings'''
+    if isinstance(data, pd.Series):
+        return data
+    if key:
+        if isinstance(data, list): # if the data is a list of dictionaries
+            return pd.Series([item[key] for item in data], dtype=object)
+        return data[key].reset_index(drop=True) # if the data is a pandas dataframe
+    return pd.Series(data, dtype=object) # if the data is a list of strings
+
+
+@timed("extract_scores", rows=lambda data, *args, **kwargs: len(data))
+def extract_scores(data, key="predict", strategy="first"):
+    '''
+    Extract the scores of a whole column of predictions at once with one compiled regex.
+    strategy: one of score_patterns, "first" gives the same scores as extract_number(position=0);
+    "fraction" rejects fractions outside 0-100 and reads the predictions without a fraction as "first" does
+    Returns a float array of scores (NaN if there is no score) and a boolean mask of the predictions that have a score.
+    '''
+    predictions = to_series(data, key)
+    predictions = predictions.where(predictions.map(type) == str)
+    if strategy == "fraction":
+        # only the predictions with a slash can have a fraction
+        matches = pd.DataFrame(index=predictions.index, columns=[0, 1], dtype=object)
+        has_slash = predictions.str.contains("/", regex=False).fillna(False).astype(bool)
+        matches[has_slash] = predictions[has_slash].str.extract(score_patterns[strategy], flags=re.DOTALL, expand=True)
+    else:
+        matches = predictions.str.extract(score_patterns[strategy], flags=re.DOTALL, expand=True)
+    # float() rather than pd.to_numeric, as \d also matches non-ASCII digits such as Devanagari ones
+    scores = np.array(matches[0].map(float, na_action="ignore"), dtype=np.float64)
+    if strategy == "fraction":
+        denominators = np.array(matches[1].map(float, na_action="ignore"), dtype=np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = scores / denominators * 100
+            scores[~np.isfinite(scores) | (scores < 0) | (scores > 100)] = np.nan
+        no_fraction = matches[0].isna().to_numpy()
+        if no_fraction.any():
+            first = extract_scores(predictions[no_fraction], key=None, strategy="first")[0]
+            scores[no_fraction] = np.where(np.isinf(first), np.nan, first)
+    elif strategy == "clamped":
+        scores = np.clip(scores, 0, 100)
+    valid = ~np.isnan(scores)
+    scores[np.isinf(scores)] = 0.0
+    return scores, valid
+
+
+def extract_sample_scores(data, key="predict", strategy="first"):
+    '''
+    Extract the scores of predictions with several samples each, as written by run.py with samples > 1,
+    with one extract_scores call over all the samples.
+    Returns a float array of shape (predictions, samples), NaN where a sample has no score or a prediction has fewer samples,
+    and the number of samples of each prediction.
+    '''
+    predictions = to_series(data, key)
+    samples = predictions.map(lambda value: value if isinstance(value, list) else [value])
+    counts = samples.map(len).to_numpy()
+    flat = samples.explode()
+    scores = np.full((len(samples), max(counts.max(initial=0), 1)), np.nan)
+    # the position of each sample in its prediction
+    positions = np.arange(len(flat)) - np.repeat(np.cumsum(counts) - counts, counts)
+    flat_scores, flat_valid = extract_scores(flat.reset_index(drop=True), key=None, strategy=strategy)
+    flat_scores[~flat_valid] = np.nan
+    scores[np.repeat(np.arange(len(samples)), counts), positions] = flat_scores
+    return scores, counts
+
+
+def aggregate_scores(scores, method="mean"):
+    '''
+    Aggregate the scores of the samples of each prediction, ignoring the samples without a score.
+    scores: an array of shape (predictions, samples), from extract_sample_scores
+    method: "mean", "median" or "majority", the most frequent score with ties going to the earlier sample
+    Returns the aggregated scores, a boolean mask of the predictions with at least one score,
+    and the variance of the scores of each prediction as a confidence signal (0 when the samples agree).
+    '''
+    scores = np.asarray(scores, dtype=np.float64)
+    valid = ~np.isnan(scores).all(axis=1)
+    aggregated = np.full(len(scores), np.nan)
+    variance = np.full(len(scores), np.nan)
+    if method == "mean":
+        aggregated[valid] = np.nanmean(scores[valid], axis=1)
+    elif method == "median":
+        aggregated[valid] = np.nanmedian(scores[valid], axis=1)
+    elif method == "majority":
+        # how often each sample's score occurs among the samples of its prediction, NaN never matches
+        counts = (scores[:, :, None] == scores[:, None, :]).sum(axis=2)
+        aggregated = scores[np.arange(len(scores)), counts.argmax(axis=1)]
+    else:
+        raise ValueError("Invalid aggregation method!")
+    variance[valid] = np.nanvar(scores[valid], axis=1)
+    return aggregated, valid, variance
+
+
+@timed("correlation", rows=lambda num, label, *args, **kwargs: len(label))
+def compute_correlation_score(num, label, dropped_index=None, valid=None):
+    '''
+    num: the extracted scores, either only those of the predictions with a number (as from extract_number)
+    or one per label (as from extract_scores)
+    dropped_index: the indices of the predictions without a number, from extract_number
+    valid: the boolean mask of the predictions with a number, from extract_scores, an alternative to dropped_index
+    '''
+    num = np.asarray(num, dtype=np.float64)
+    label = np.asarray(label)
+    if valid is None and dropped_index and len(num) != len(label):
+        valid = np.ones(len(label), dtype=bool)
+        valid[np.asarray(dropped_index, dtype=np.int64)] = False
+    if valid is not None and len(num) == len(label):
+        num = num[valid]
     if len(num) != len(label):
-        if dropped_index:
+        if valid is not None:
             # drop the corresponding label if there is no number in the prediction
-            new_label = [label[i] for i in range(len(label)) if i not in dropped_index]
+            new_label = label[valid]
         else:
             print("The number of predictions and labels are not equal. Please check the data.")
             new_label = label
     else:
         new_label = label
-    
-    print(spearmanr(num, new_label))
-    print(pearsonr(num, new_label))
-    print(kendalltau(num, new_label))
 
-    return round(spearmanr(num, new_label)[0], 4), round(pearsonr(num, new_label)[0], 4), round(kendalltau(num, new_label)[0], 4)
+    spearman = spearmanr(num, new_label)
+    pearson = pearsonr(num, new_label)
+    kendall = kendalltau(num, new_label)
+    print(spearman)
+    print(pearson)
+    print(kendall)
 
+    return round(spearman[0], 4), round(pearson[0], 4), round(kendall[0], 4)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compute the correlations of LLM scores with the DA scores")
+    parser.add_argument("--report", type=str, default=None, help="Evaluate every output file under this folder into one table, instead of the template_version set below")
+    parser.add_argument("--report_file", type=str, default=None, help="The table of the report, default is <report folder>/correlation_report.tsv")
+    parser.add_argument("--raw_data", type=str, default="./raw_data/", help="The folder of the gold labels")
+    parser.add_argument("--strategy", type=str, default="first", choices=list(score_patterns), help="How the scores are extracted, see score_patterns")
+    parser.add_argument("--aggregation", type=str, default="mean", choices=["mean", "median", "majority"], help="How the samples of a prompt are combined")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="The number of processes parsing the output files")
+    parser.add_argument("--incremental", action="store_true", help="Only evaluate the output files whose content changed since the last report")
+    args = parser.parse_args()
+    return args
+
+
+'''the file name of an output of run.py: <PAIR>_outputs_t<template>-<model>.<tsv|parquet>'''
+output_file_pattern = re.compile(r"^([A-Z]{2}-[A-Z]{2})_outputs_t([^-]+)-(.+)\.(tsv|parquet)$")
+
+
+def discover_outputs(folder):
+    '''
+    Every output file under folder as a dataframe of path, lang_pair, template and model.
+    When the same output is both a tsv and a Parquet file, the Parquet file is used, as in read_outputs.
+    The outputs of the first CoT prompt (7p1) are analyses kept for auditing, not scores, and are left out.
+    '''
+    found = {}
+    for root, _, files in os.walk(folder):
+        for name in sorted(files):
+            match = output_file_pattern.match(name)
+            if match and match.group(2) != "7p1":
+                lang_pair, template, model, extension = match.groups()
+                key = (root, lang_pair.lower(), template, model)
+                if extension == "parquet" or key not in found:
+                    found[key] = os.path.join(root, name)
+    return pd.DataFrame([{"path": path, "lang_pair": lang_pair, "template": template, "model": model} for (_, lang_pair, template, model), path in sorted(found.items())],
+                        columns=["path", "lang_pair", "template", "model"])
 
-if __name__ == "__main__":
-    
-    template_version = "03-mixtral"
-    subfolder = "./llm_output_samples/"
 
-    language_pairs = ["en-de", "en-mr", "en-zh", "et-en", "ne-en", "ro-en", "ru-en", "si-en"]
+def gold_labels(lang_pairs, raw_data="./raw_data/"):
+    '''the rounded DA scores of the test split of each language pair, read once'''
+    labels = {}
+    for lang_pair in sorted(set(lang_pairs)):
+        gold_file = os.path.join(raw_data, lang_pair, lang_pair + "_overlaps_test.tsv")
+        if os.path.exists(gold_file):
+            labels[lang_pair] = np.array(list(map(round, read_tsv(gold_file)["score"].tolist())), dtype=np.float64)
+    return labels
+
+
+# the gold labels of a report worker process, set once per process by set_gold_labels
+_gold_labels = {}
+
+
+def set_gold_labels(labels):
+    global _gold_labels
+    _gold_labels = labels
+
+
+def evaluate_output(path, lang_pair, strategy="first", aggregation="mean"):
+    '''
+    the correlations, dropped rows and timings of one output file, against the gold labels of the worker;
+    a file that cannot be read or parsed gets its error as status instead of stopping the whole report
+    '''
+    result = {"status": "ok", "rows": 0, "dropped_rows": 0, "drop_rate": np.nan, "spearman": np.nan, "pearson": np.nan, "kendall": np.nan, "variance": np.nan}
+    try:
+        _evaluate_output(result, path, lang_pair, strategy, aggregation)
+    except Exception as e:
+        result["status"] = "error: %s: %s" % (type(e).__name__, e)
+    return result
+
+
+def _evaluate_output(result, path, lang_pair, strategy, aggregation):
+    '''fills in result, see evaluate_output'''
+    begin = time.perf_counter()
+    data = read_outputs(path)
+    result["read_time"] = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    if data["vllm_output"].map(lambda value: isinstance(value, list)).any():
+        num, valid, variance = aggregate_scores(extract_sample_scores(data, key="vllm_output", strategy=strategy)[0], aggregation)
+        result["variance"] = float(np.nanmean(variance)) if valid.any() else np.nan
+    else:
+        num, valid = extract_scores(data, key="vllm_output", strategy=strategy)
+    result["parse_time"] = time.perf_counter() - begin
+
+    label = _gold_labels.get(lang_pair)
+    result["rows"] = len(num)
+    result["dropped_rows"] = int((~valid).sum())
+    result["drop_rate"] = result["dropped_rows"] / len(num) if len(num) else np.nan
+    begin = time.perf_counter()
+    if label is None:
+        result["status"] = "no labels"
+    elif len(label) != len(num):
+        result["status"] = "%d rows for %d labels" % (len(num), len(label))
+    elif valid.sum() < 2:
+        result["status"] = "no scores"
+    else:
+        result["spearman"] = spearmanr(num[valid], label[valid])[0]
+        result["pearson"] = pearsonr(num[valid], label[valid])[0]
+        result["kendall"] = kendalltau(num[valid], label[valid])[0]
+    result["corr_time"] = time.perf_counter() - begin
+
+
+def evaluation_report(folder, raw_data="./raw_data/", strategy="first", aggregation="mean", workers=None, manifest_file=None):
+    '''
+    Evaluate every output file under folder in a process pool, with the gold labels of each language pair read once and
+    sent once to each worker. Returns one table with the correlations, dropped rows, drop rate and timings of every output file.
+    manifest_file: the results of the last report keyed by file hash; if given, only the files that changed or are new are evaluated
+    '''
+    outputs = discover_outputs(folder)
+    # the results of another gold folder, or of gold files that changed since, are not reused
+    gold_files = {lang_pair: os.path.join(raw_data, lang_pair, lang_pair + "_overlaps_test.tsv") for lang_pair in sorted(set(outputs["lang_pair"]))}
+    settings = {"strategy": strategy, "aggregation": aggregation, "raw_data": os.path.abspath(raw_data),
+                "gold": {lang_pair: file_hash(gold_file) for lang_pair, gold_file in gold_files.items() if os.path.exists(gold_file)}}
+    manifest = {}
+    if manifest_file and os.path.exists(manifest_file):
+        with open(manifest_file, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("settings") != settings:
+            manifest = {}
+    previous = manifest.get("files", {})
+
+    hashes = [file_hash(path) for path in outputs["path"]]
+    todo = [i for i, (path, digest) in enumerate(zip(outputs["path"], hashes)) if previous.get(path, {}).get("hash") != digest]
+    print("Evaluating %d of %d output files." % (len(todo), len(outputs)))
+
+    labels = gold_labels(outputs["lang_pair"].iloc[todo], raw_data)
+    jobs = [(outputs["path"].iloc[i], outputs["lang_pair"].iloc[i], strategy, aggregation) for i in todo]
+    if workers and workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), initializer=set_gold_labels, initargs=(labels,)) as pool:
+            results = list(pool.map(evaluate_output, *zip(*jobs)))
+    else:
+        set_gold_labels(labels)
+        results = [evaluate_output(*job) for job in jobs]
+
+    files = {path: previous[path] for path in outputs["path"] if path in previous}
+    for i, result in zip(todo, results):
+        files[outputs["path"].iloc[i]] = {"hash": hashes[i], "result": result}
+    if manifest_file:
+        # the files that failed are evaluated again next time, e.g. once they are fully written
+        with open(manifest_file, "w", encoding="utf-8") as f:
+            json.dump({"settings": settings, "files": {path: entry for path, entry in files.items() if not entry["result"]["status"].startswith("error")}}, f, indent=1)
+
+    report = pd.concat([outputs.reset_index(drop=True), pd.DataFrame([files[path]["result"] for path in outputs["path"]])], axis=1)
+    for column in ("spearman", "pearson", "kendall", "drop_rate", "variance", "read_time", "parse_time", "corr_time"):
+        if column in report:
+            report[column] = report[column].astype(float).round(4)
+    return report.sort_values(["template", "model", "lang_pair"]).reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.report:
+        report_file = args.report_file if args.report_file else os.path.join(args.report, "correlation_report.tsv")
+        manifest_file = os.path.splitext(report_file)[0] + ".manifest.json" if args.incremental else None
+        begin = time.perf_counter()
+        report = evaluation_report(args.report, args.raw_data, args.strategy, args.aggregation, args.workers, manifest_file)
+        report.to_csv(report_file, sep="\t", index=False, encoding="utf-8")
+        print(report.drop(columns="path").to_string(index=False))
+        print("Report of %d output files in %.2fs saved to %s" % (len(report), time.perf_counter() - begin, report_file))
+    else:
+        template_version = "03-mixtral"
+        subfolder = "./llm_output_samples/"
+        # how the samples of each prompt are combined when run.py sampled several per prompt
+        aggregation = "mean"
 
-    #put results into a dataframe
-    df = pd.DataFrame(columns=['spearman','pearson','kendall','dropped_rows'], index=language_pairs)
-    for language_pair in language_pairs:
-        print("%s:" % language_pair)
-        data = pd.read_csv(subfolder + language_pair.upper() + "_outputs_t" + template_version + ".tsv", sep='\t', encoding='utf-8', on_bad_lines='skip')
-        num, dropped_index = extract_number(data, key="vllm_output", position=0)
-        label = list(map(round, read_tsv("./raw_data/" + language_pair + "/" + language_pair + "_overlaps_test.tsv")["score"].tolist()))
+        language_pairs = ["en-de", "en-mr", "en-zh", "et-en", "ne-en", "ro-en", "ru-en", "si-en"]
 
-        corrs = compute_correlation_score(num, label, dropped_index)
-        print("Dropped rows: ", len(dropped_index))
+        #put results into a dataframe
+        df = pd.DataFrame(columns=['spearman','pearson','kendall','dropped_rows'], index=language_pairs)
+        for language_pair in language_pairs:
+            print("%s:" % language_pair)
+            output_file = subfolder + language_pair.upper() + "_outputs_t" + template_version
+            output_file = output_file + ".parquet" if os.path.exists(output_file + ".parquet") else output_file + ".tsv"
+            if not os.path.exists(output_file):
+                print("No output file %s, skipped." % output_file)
+                continue
+            data = read_outputs(output_file)
+            label = list(map(round, read_tsv("./raw_data/" + language_pair + "/" + language_pair + "_overlaps_test.tsv")["score"].tolist()))
+            if data["vllm_output"].map(lambda value: isinstance(value, list)).any():
+                num, valid, variance = aggregate_scores(extract_sample_scores(data, key="vllm_output")[0], aggregation)
+                dropped_index = np.flatnonzero(~valid).tolist()
+                print("Mean variance of the samples: ", round(float(np.nanmean(variance)), 4))
+                corrs = compute_correlation_score(num, label, valid=valid)
+            else:
+                num, dropped_index = extract_number(data, key="vllm_output", position=0)
+                corrs = compute_correlation_score(num, label, dropped_index)
+            print("Dropped rows: ", len(dropped_index))
 
-        df.loc[language_pair] = [corrs[0], corrs[1], corrs[2], len(dropped_index)]
+            df.loc[language_pair] = [corrs[0], corrs[1], corrs[2], len(dropped_index)]
         
-    df.to_excel(subfolder + "correlation_scores_t" + template_version + ".xlsx", index=True)
\ No newline at end of file
+        df.to_excel(subfolder + "correlation_scores_t" + template_version + ".xlsx", index=True)
\ No newline at end of file
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import os
+import ast
+import argparse
+import numpy as np
+import pandas as pd
+from preflight import file_hash
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert LLM output tsv files to Parquet and back")
+    parser.add_argument("--convert", type=str, nargs="+", required=True, help="The output files to convert, .tsv files become .parquet and .parquet files become .tsv")
+    parser.add_argument("--prompt_file", type=str, default=None, help="The prompt file the outputs were generated from, so only prompt IDs are stored")
+    args = parser.parse_args()
+    return args
+
+
+def write_outputs_columnar(output_file, generated, prompt_ids=None, prompts=None, prompt_tokens=None, completion_tokens=None, gen_time=None, metadata=None):
+    '''
+    Write the outputs to a Parquet file with one row per prompt: prompt_id (the row in the prompt file), vllm_output
+    (a list of texts when several samples were generated per prompt),
+    and if given prompt_tokens, completion_tokens and gen_time (seconds). The prompts themselves are only stored when
+    they cannot be looked up in a prompt file, and the key-value metadata (e.g. prompt_file, prompt_file_hash, model_name) is kept in the file.
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    samples = any(isinstance(text, list) for text in generated)
+    if samples:
+        # rows left out of generation have a single empty text
+        generated = [text if isinstance(text, list) else [text] for text in generated]
+    columns = {
+        "prompt_id": pa.array(prompt_ids if prompt_ids is not None else range(len(generated)), type=pa.int64()),
+        "vllm_output": pa.array(generated, type=pa.list_(pa.string()) if samples else pa.string()),
+    }
+    if prompts is not None:
+        columns["prompt"] = pa.array(prompts, type=pa.string()).dictionary_encode()
+    for name, values, type in (("prompt_tokens", prompt_tokens, pa.int32()), ("completion_tokens", completion_tokens, pa.int32()), ("gen_time", gen_time, pa.float32())):
+        if values is not None:
+            columns[name] = pa.array(values, type=type)
+    table = pa.table(columns).replace_schema_metadata({str(key): str(value) for key, value in (metadata or {}).items()})
+    pq.write_table(table, output_file, compression="zstd")
+
+
+def read_outputs_metadata(output_file):
+    import pyarrow.parquet as pq
+    metadata = pq.read_schema(output_file).metadata or {}
+    return {key.decode("utf-8"): value.decode("utf-8") for key, value in metadata.items() if not key.startswith(b"pandas")}
+
+
+def read_tsv_outputs(output_file):
+    '''
+    Read a tsv written by run.py, where each line is repr(prompt)\\trepr(output), without skipping any row.
+    The fields are decoded back to the original texts; a field that is not a Python literal is kept as it is.
+    '''
+    def decode(field):
+        try:
+            return ast.literal_eval(field)
+        except (ValueError, SyntaxError):
+            return field
+
+    prompts, generated = [], []
+    with open(output_file, "r", encoding="utf-8", newline="\n") as f:
+        next(f)
+        for line in f:
+            prompt, _, generated_text = line.rstrip("\n").partition("\t")
+            prompts.append(decode(prompt))
+            generated.append(decode(generated_text))
+    return pd.DataFrame({"prompt_id": range(len(prompts)), "prompt": prompts, "vllm_output": generated})
+
+
+def read_outputs(output_file, with_prompts=False):
+    '''
+    Read an output file, either a tsv written by run.py or a Parquet file, as a DataFrame with prompt_id and vllm_output.
+    with_prompts: also fill the prompt column of a Parquet file from its prompt file if only the prompt IDs are stored,
+    a ValueError is raised if the prompt file changed since
+    '''
+    if not output_file.endswith(".parquet"):
+        return read_tsv_outputs(output_file)
+    df = pd.read_parquet(output_file)
+    if df["vllm_output"].map(lambda value: isinstance(value, np.ndarray)).any():
+        # the samples of each prompt come back as arrays
+        df["vllm_output"] = df["vllm_output"].map(lambda value: value.tolist() if isinstance(value, np.ndarray) else value)
+    if "prompt" in df:
+        df["prompt"] = df["prompt"].astype(object)
+    elif with_prompts:
+        metadata = read_outputs_metadata(output_file)
+        prompt_file = metadata["prompt_file"]
+        if "prompt_file_hash" in metadata and file_hash(prompt_file) != metadata["prompt_file_hash"]:
+            raise ValueError("%s changed since %s was generated from it, its rows may not match the prompt IDs!" % (prompt_file, output_file))
+        prompts = pd.read_csv(prompt_file, sep="\t", encoding="utf-8")["final_prompt"]
+        df["prompt"] = prompts.to_numpy(dtype=object)[df["prompt_id"].to_numpy()]
+    return df
+
+
+def tsv_to_parquet(tsv_file, parquet_file=None, prompt_file=None):
+    '''
+    Convert a tsv written by run.py to Parquet without losing any row. If every prompt matches the same row of prompt_file,
+    only the prompt IDs are stored, otherwise the prompts are stored dictionary-encoded.
+    '''
+    parquet_file = parquet_file if parquet_file else os.path.splitext(tsv_file)[0] + ".parquet"
+    df = read_tsv_outputs(tsv_file)
+    metadata = {"source_file": os.path.basename(tsv_file)}
+    prompts = df["prompt"].tolist()
+    if prompt_file:
+        final_prompts = pd.read_csv(prompt_file, sep="\t", encoding="utf-8")["final_prompt"].tolist()
+        if final_prompts == prompts:
+            metadata.update({"prompt_file": prompt_file, "prompt_file_hash": file_hash(prompt_file)})
+            prompts = None
+        else:
+            print("%s does not match %s row by row, storing the prompts." % (tsv_file, prompt_file))
+    write_outputs_columnar(parquet_file, df["vllm_output"].tolist(), prompt_ids=df["prompt_id"].tolist(), prompts=prompts, metadata=metadata)
+    return parquet_file
+
+
+def parquet_to_tsv(parquet_file, tsv_file=None):
+    '''convert a Parquet output file back to the tsv written by run.py'''
+    from run import write_outputs
+    tsv_file = tsv_file if tsv_file else os.path.splitext(parquet_file)[0] + ".tsv"
+    df = read_outputs(parquet_file, with_prompts=True)
+    write_outputs(tsv_file, df["prompt"].tolist(), df["vllm_output"].tolist())
+    return tsv_file
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    for output_file in args.convert:
+        if output_file.endswith(".parquet"):
+            print("%s -> %s" % (output_file, parquet_to_tsv(output_file)))
+        else:
+            print("%s -> %s" % (output_file, tsv_to_parquet(output_file, prompt_file=args.prompt_file)))
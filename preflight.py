@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Check the token lengths of prompt files before running vLLM")
+    parser.add_argument("--model_name", type=str, required=True, help="The model name from HuggingFace whose tokenizer is used")
+    parser.add_argument("--prompt_files", type=str, nargs="+", required=True, help="The prompt files, e.g. prompts/llama/*.tsv")
+    parser.add_argument("--max_model_len", type=int, default=1024, help="The context length the model is loaded with")
+    parser.add_argument("--max_tokens", type=int, default=512, help="The maximum number of generated tokens")
+    parser.add_argument("--cache_dir", type=str, default="./.cache/token_lengths/", help="The folder to cache token lengths")
+    parser.add_argument("--prefix", action="store_true", help="Report the tokens shared by every prompt of each file instead, i.e. the prefill that prefix caching saves")
+    parser.add_argument("--block_size", type=int, default=16, help="The KV cache block size, prefix caching reuses whole blocks only")
+    args = parser.parse_args()
+    return args
+
+
+def file_hash(file_name):
+    '''sha1 of the content of a file'''
+    sha1 = hashlib.sha1()
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def read_prompts(prompt_file):
+    return pd.read_csv(prompt_file, sep="\t", encoding="utf-8")["final_prompt"].tolist()
+
+
+def load_tokenizer(model_name):
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(model_name)
+
+
+def length_cache_file(prompt_file, model_name, cache_dir="./.cache/token_lengths/"):
+    '''the file caching the token lengths of prompt_file for model_name'''
+    return os.path.join(cache_dir, model_name.replace("/", "--") + "_" + file_hash(prompt_file)[:16] + ".npy")
+
+
+def token_lengths(prompt_file, model_name, tokenizer=None, cache_dir="./.cache/token_lengths/", batch_size=1024):
+    '''
+    The number of tokens of each prompt in prompt_file, counted the way vLLM tokenizes it.
+    Lengths are cached per (model, prompt file content) in cache_dir, so the tokenizer is only loaded on a cache miss.
+    '''
+    cache_file = length_cache_file(prompt_file, model_name, cache_dir)
+    if os.path.exists(cache_file):
+        return np.load(cache_file)
+
+    lengths = count_tokens(read_prompts(prompt_file), tokenizer if tokenizer else load_tokenizer(model_name), batch_size)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(cache_file, lengths)
+    return lengths
+
+
+def count_tokens(prompts, tokenizer, batch_size=1024):
+    '''the number of tokens of each prompt, tokenized in batches'''
+    lengths = np.zeros(len(prompts), dtype=np.int64)
+    for start in range(0, len(prompts), batch_size):
+        input_ids = tokenizer(prompts[start:start + batch_size])["input_ids"]
+        lengths[start:start + len(input_ids)] = [len(ids) for ids in input_ids]
+    return lengths
+
+
+def prompt_lengths(prompts, model_name, tokenizer=None, cache_dir="./.cache/token_lengths/", batch_size=1024):
+    '''
+    The token lengths of prompts built in memory rather than read from a prompt file, e.g. the first CoT prompts,
+    cached like token_lengths per (model, prompts).
+    '''
+    sha1 = hashlib.sha1()
+    for prompt in prompts:
+        sha1.update(prompt.encode("utf-8") + b"\0")
+    cache_file = os.path.join(cache_dir, model_name.replace("/", "--") + "_prompts-" + sha1.hexdigest()[:16] + ".npy")
+    if os.path.exists(cache_file):
+        return np.load(cache_file)
+    lengths = count_tokens(prompts, tokenizer if tokenizer else load_tokenizer(model_name), batch_size)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(cache_file, lengths)
+    return lengths
+
+
+def describe_lengths(lengths, max_model_len=1024, max_tokens=512):
+    '''
+    The length distribution of the prompts, with the number of prompts that do not fit the context at all (overflow)
+    and the number that fit but leave less than max_tokens for the output (truncated).
+    '''
+    lengths = np.asarray(lengths)
+    return {
+        "prompts": len(lengths),
+        "min": int(lengths.min()),
+        "mean": round(float(lengths.mean()), 1),
+        "p50": int(np.percentile(lengths, 50)),
+        "p90": int(np.percentile(lengths, 90)),
+        "p99": int(np.percentile(lengths, 99)),
+        "max": int(lengths.max()),
+        "overflow": int((lengths >= max_model_len).sum()),
+        "truncated": int(((lengths < max_model_len) & (lengths + max_tokens > max_model_len)).sum()),
+    }
+
+
+def fit_to_context(lengths, max_model_len=1024, max_tokens=512, overflow="drop"):
+    '''
+    A boolean mask of the prompts to send to the model, the prompts that do not fit the context are handled by overflow:
+    "drop" leaves them out, "error" raises a ValueError before the model is loaded,
+    "warn" keeps every prompt and prints how many overflow, for backends that truncate long prompts themselves
+    (vLLM rejects them and the run fails after loading the model).
+    '''
+    lengths = np.asarray(lengths)
+    fits = lengths < max_model_len
+    short = int((fits & (lengths + max_tokens > max_model_len)).sum())
+    if short:
+        print("%d prompts leave fewer than %d tokens for the output and may be cut short." % (short, max_tokens))
+    if fits.all():
+        return fits
+    if overflow == "error":
+        raise ValueError("%d prompts are longer than max_model_len=%d!" % ((~fits).sum(), max_model_len))
+    elif overflow == "drop":
+        print("Dropping %d prompts longer than max_model_len=%d." % ((~fits).sum(), max_model_len))
+        return fits
+    elif overflow == "warn":
+        print("%d prompts are longer than max_model_len=%d and will be rejected by the model." % ((~fits).sum(), max_model_len))
+        return np.ones(len(lengths), dtype=bool)
+    else:
+        raise ValueError("Invalid overflow policy!")
+
+
+def length_order(lengths):
+    '''the prompt indices sorted by token length, so neighbouring prompts in a batch need little padding'''
+    return np.argsort(lengths, kind="stable")
+
+
+def shared_prefix_tokens(prompts, tokenizer):
+    '''
+    The number of leading tokens every prompt has in common. The common text is tokenized on its own,
+    and its last token is not counted since it may merge with the text that follows it in a prompt.
+    '''
+    prefix = os.path.commonprefix(prompts)
+    if not prefix:
+        return 0
+    return max(len(tokenizer(prefix)["input_ids"]) - 1, 0)
+
+
+def describe_prefix(lengths, prefix_tokens, block_size=16):
+    '''
+    How much of the prefill of a prompt file is shared: the prefix reusable from the cache in whole blocks,
+    its fraction of all prompt tokens, and the fraction of prefill saved when the prefix is computed once for all prompts.
+    '''
+    lengths = np.asarray(lengths)
+    cached = prefix_tokens // block_size * block_size
+    total = int(lengths.sum())
+    return {
+        "prompts": len(lengths),
+        "prompt_tokens": total,
+        "prefix_tokens": int(prefix_tokens),
+        "cached_tokens": int(cached),
+        "shared_fraction": round(prefix_tokens * len(lengths) / total, 4) if total else 0.0,
+        "prefill_saved": round(cached * (len(lengths) - 1) / total, 4) if total else 0.0,
+    }
+
+
+def prefix_report(prompt_files, model_name, block_size=16, cache_dir="./.cache/token_lengths/"):
+    '''the shared prefix of every prompt file, indexed by language pair and template as in preflight'''
+    tokenizer = load_tokenizer(model_name)
+    rows = {}
+    for prompt_file in prompt_files:
+        name = os.path.basename(prompt_file)[:-len(".tsv")]
+        lang_pair, template = name.split("_vllm_t")
+        lengths = token_lengths(prompt_file, model_name, tokenizer=tokenizer, cache_dir=cache_dir)
+        rows[(lang_pair, template)] = describe_prefix(lengths, shared_prefix_tokens(read_prompts(prompt_file), tokenizer), block_size)
+    df = pd.DataFrame.from_dict(rows, orient="index")
+    df.index.names = ["lang_pair", "template"]
+    return df.sort_index()
+
+
+def preflight(prompt_files, model_name, max_model_len=1024, max_tokens=512, cache_dir="./.cache/token_lengths/"):
+    '''the length distribution of every prompt file, indexed by language pair and template parsed from <pair>_vllm_t<template>.tsv'''
+    tokenizer = None
+    rows = {}
+    for prompt_file in prompt_files:
+        name = os.path.basename(prompt_file)[:-len(".tsv")]
+        lang_pair, template = name.split("_vllm_t")
+        if tokenizer is None and not os.path.exists(length_cache_file(prompt_file, model_name, cache_dir)):
+            tokenizer = load_tokenizer(model_name)
+        lengths = token_lengths(prompt_file, model_name, tokenizer=tokenizer, cache_dir=cache_dir)
+        rows[(lang_pair, template)] = describe_lengths(lengths, max_model_len, max_tokens)
+    df = pd.DataFrame.from_dict(rows, orient="index")
+    df.index.names = ["lang_pair", "template"]
+    return df.sort_index()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.prefix:
+        report = prefix_report(args.prompt_files, args.model_name, args.block_size, args.cache_dir)
+        print(report.to_string())
+        print("Prefill saved by prefix caching over all files: %.2f%%" % (100 * (report["prefill_saved"] * report["prompt_tokens"]).sum() / report["prompt_tokens"].sum()))
+    else:
+        report = preflight(args.prompt_files, args.model_name, args.max_model_len, args.max_tokens, args.cache_dir)
+        print(report.to_string())
+        print("Prompts longer than max_model_len=%d: %d" % (args.max_model_len, report["overflow"].sum()))
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+
+class ResponseCache:
+    '''
+    A persistent cache of generated texts in a SQLite file, keyed by a hash of (model, quantization, sampling params, seed, prompt).
+    When the cached texts grow beyond max_bytes, the least recently used entries are evicted.
+    path: the SQLite file of the cache
+    max_bytes: the size bound of the cached texts
+    '''
+    def __init__(self, path="./.cache/responses.sqlite", max_bytes=2 * 1024 ** 3) -> None:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, text TEXT, size INTEGER, last_used REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        # caches created before the generated tokens were kept get the column, their entries have none
+        if "tokens" not in [column[1] for column in self.conn.execute("PRAGMA table_info(responses)")]:
+            self.conn.execute("ALTER TABLE responses ADD COLUMN tokens INTEGER")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(prompt, model=None, quantization=None, sampling=None, seed=None):
+        '''sampling: a dict of the sampling params, e.g. {"temperature": 0.8, "top_p": 0.95, "max_tokens": 512}'''
+        content = json.dumps({"model": model, "quantization": quantization, "sampling": sampling, "seed": seed, "prompt": prompt}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys, with_tokens=False):
+        '''the cached texts of the keys found, as a dict of key -> text, or of key -> (text, generated tokens) with_tokens'''
+        found = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            rows = self.conn.execute("SELECT key, text, tokens FROM responses WHERE key IN (%s)" % ",".join("?" * len(batch)), batch).fetchall()
+            found.update((key, (text, tokens) if with_tokens else text) for key, text, tokens in rows)
+        if found:
+            now = time.time()
+            self.conn.executemany("UPDATE responses SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+            self.conn.commit()
+        return found
+
+    def put_many(self, items, tokens=None):
+        '''items: a dict of key -> text, tokens: a dict of key -> the number of tokens generated for it'''
+        now = time.time()
+        tokens = tokens if tokens else {}
+        self.conn.executemany("INSERT OR REPLACE INTO responses (key, text, size, last_used, tokens) VALUES (?, ?, ?, ?, ?)",
+                              [(key, text, len(text.encode("utf-8")), now, tokens.get(key)) for key, text in items.items()])
+        self.conn.commit()
+        self.evict()
+
+    def size(self):
+        return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def evict(self):
+        '''drop the least recently used entries until the cache is back under max_bytes'''
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return
+        evicted = []
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self.conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / total, 4) if total else 0.0, "entries": self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0], "bytes": self.size()}
+
+    def close(self):
+        self.conn.close()
+
+
+def cached_generator(generate, cache, model=None, quantization=None, sampling=None, seed=None, samples=False, with_tokens=False):
+    '''
+    Put a cache in front of a function from a list of prompts to a list of generated texts.
+    Only the prompts missing from the cache are sent to generate, each distinct prompt once, and the results are merged back in order.
+    samples: generate returns a list of texts per prompt, which is cached as JSON
+    with_tokens: generate returns the texts and the number of generated tokens of each prompt, as the backends of sweep.py do,
+    and so does the cached function; the tokens of entries cached without them are None
+    '''
+    def generate_cached(prompts):
+        keys = [ResponseCache.key(prompt, model, quantization, sampling, seed) for prompt in prompts]
+        found = cache.get_many(set(keys), with_tokens=True)
+        missing = {}
+        for key, prompt in zip(keys, prompts):
+            if key not in found:
+                missing.setdefault(key, prompt)
+        # a prompt repeated in the batch is generated once, its other copies count as hits
+        cache.hits += len(keys) - len(missing)
+        cache.misses += len(missing)
+        found = {key: (json.loads(text) if samples else text, tokens) for key, (text, tokens) in found.items()}
+        if missing:
+            result = generate(list(missing.values()))
+            texts, tokens = result if with_tokens else (result, [None] * len(missing))
+            generated = dict(zip(missing, zip(texts, tokens)))
+            cache.put_many({key: json.dumps(text, ensure_ascii=False) if samples else text for key, (text, _) in generated.items()},
+                           tokens={key: n for key, (_, n) in generated.items()})
+            found.update(generated)
+        if with_tokens:
+            return [found[key][0] for key in keys], [found[key][1] for key in keys]
+        return [found[key][0] for key in keys]
+    return generate_cached
@@ -1,5 +1,17 @@
-from vllm import LLM, SamplingParams
+import os
+import ast
+import json
+import math
+import time
+import numpy as np
 import pandas as pd
+from prompt_building import VllmTemplate, model_formats
+from preflight import token_lengths, prompt_lengths, describe_lengths, fit_to_context, length_order, file_hash
+from response_cache import ResponseCache, cached_generator
+from output_store import write_outputs_columnar
+from score_decoding import score_sampling_kwargs, step_logprobs, expected_score
+from openai_client import OpenAIBackend
+from instrumentation import metrics, stage, count, timed
 
 
 model_type = "./prompts/llama/"
@@ -9,24 +21,407 @@ lang_pair = "en-de"
 quantization = None
 
 
-def main(max_model_len=1024, gpu_memory_util=0.9, quantization=None, temperature=0.8, top_p=0.95):
-    data = pd.read_csv(model_type + lang_pair + "_vllm_t" + template + ".tsv", encoding="utf-8", sep="\t")
-    prompts = data["final_prompt"].tolist()
+def output_file_name(lang_pair, template, model_name, output_format="tsv"):
+    return lang_pair.upper() + "_outputs_t" + template + "-" + model_name.split("/")[-1] + "." + output_format
+
 
+@timed("write_outputs", rows=lambda output_file, prompts, *args, **kwargs: len(prompts))
+def write_outputs(output_file, prompts, generated, prompt_file=None, metadata=None, **columns):
+    '''
+    Write the prompts and generated texts, in prompt order, to the tsv read by output_parser.py, 
+    or to Parquet if output_file ends with .parquet. A Parquet file stores the row IDs of prompt_file instead of the prompts,
+    with the optional columns prompt_tokens, completion_tokens and gen_time.
+    '''
+    if output_file.endswith(".parquet"):
+        metadata = dict(metadata or {})
+        if prompt_file:
+            metadata.update({"prompt_file": prompt_file, "prompt_file_hash": file_hash(prompt_file)})
+        write_outputs_columnar(output_file, generated, prompts=None if prompt_file else prompts, metadata=metadata, **columns)
+        return
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write(f"prompt\tvllm_output\n")
+        for prompt, generated_text in zip(prompts, generated):
+            f.write(f"{prompt!r}\t{generated_text!r}\n")
 
-    sampling_params = SamplingParams(temperature=temperature, top_p=top_p, max_tokens=512)
 
-    llm = LLM(model=model_name, gpu_memory_utilization=gpu_memory_util, max_model_len=max_model_len, dtype="auto", quantization=quantization) 
+def completion_tokens(outputs):
+    '''
+    The tokens generated for each of a batch of vLLM RequestOutputs, summed over its completions,
+    which are also added to the completion_tokens counter
+    '''
+    tokens = [sum(len(completion.token_ids) for completion in output.outputs) for output in outputs]
+    count("completion_tokens", sum(tokens))
+    return tokens
 
-    outputs = llm.generate(prompts, sampling_params)
 
-    with open(lang_pair.upper() + "_outputs_t" + template + "-" + model_name.split("/")[-1] + ".tsv", "w", encoding="utf-8") as f:
-        f.write(f"prompt\tvllm_output\n")
-        for output in outputs:
-            prompt = output.prompt
-            generated_text = output.outputs[0].text
-            f.write(f"{prompt!r}\t{generated_text!r}\n")
-    print("Done!")
+def split_generated(result):
+    '''the texts and generated tokens returned by a generate function, which may return the texts alone, e.g. a stub'''
+    if isinstance(result, tuple):
+        return list(result[0]), list(result[1])
+    return list(result), [None] * len(result)
+
+
+def vllm_generator(llm, sampling_params):
+    '''wrap a vLLM engine as a function from a list of prompts to their generated texts and numbers of generated tokens'''
+    def generate(prompts):
+        outputs = llm.generate(prompts, sampling_params, use_tqdm=False)
+        return [output.outputs[0].text for output in outputs], completion_tokens(outputs)
+    return generate
+
+
+def vllm_samples_generator(llm, sampling_params):
+    '''
+    wrap a vLLM engine sampling sampling_params.n completions per prompt as a function from a list of prompts
+    to a list of lists of texts and the tokens generated for each prompt
+    '''
+    def generate(prompts):
+        outputs = llm.generate(prompts, sampling_params, use_tqdm=False)
+        return [[completion.text for completion in output.outputs] for output in outputs], completion_tokens(outputs)
+    return generate
+
+
+def self_consistent_generator(generate_first, generate_rest, agreement=0.0, strategy="first"):
+    '''
+    Sample the completions of each prompt in two rounds to stop early on the prompts the model is already sure about:
+    generate_first samples the first completions of every prompt, and generate_rest the remaining ones,
+    only for the prompts whose first scores do not all exist and lie within agreement of each other.
+    generate_first, generate_rest: functions from a list of prompts to a list of lists of texts and generated tokens, e.g. vllm_samples_generator,
+    with different seeds so the second round does not repeat the first
+    strategy: how the scores are extracted, see output_parser.score_patterns
+    '''
+    from output_parser import extract_sample_scores
+
+    def generate(prompts):
+        samples, tokens = split_generated(generate_first(prompts))
+        samples = [list(texts) for texts in samples]
+        scores = extract_sample_scores(samples, key=None, strategy=strategy)[0]
+        with np.errstate(invalid="ignore"):
+            agree = ~np.isnan(scores).any(axis=1) & (np.ptp(scores, axis=1) <= agreement)
+        todo = np.flatnonzero(~agree)
+        if len(todo):
+            for i, texts, n in zip(todo, *split_generated(generate_rest([prompts[i] for i in todo]))):
+                samples[i].extend(texts)
+                tokens[i] = tokens[i] + n if tokens[i] is not None and n is not None else None
+        return samples, tokens
+    return generate
+
+
+def vllm_score_generator(llm, sampling_params):
+    '''
+    Wrap a vLLM engine in the score-only mode. When sampling_params keeps logprobs, each output is the JSON record of its tokens
+    and top logprobs (see score_decoding.step_logprobs) instead of the text, so that the records are cached and resumed
+    like any output; expected_score_outputs turns them into the outputs once every row is done.
+    '''
+    def generate(prompts):
+        outputs = llm.generate(prompts, sampling_params, use_tqdm=False)
+        if not sampling_params.logprobs:
+            return [output.outputs[0].text for output in outputs], completion_tokens(outputs)
+        return [json.dumps(step_logprobs(output.outputs[0]), ensure_ascii=False) for output in outputs], completion_tokens(outputs)
+    return generate
+
+
+def expected_score_outputs(generated, logprobs_file):
+    '''
+    The outputs of the score-only mode with logprobs, from the JSON records of every prompt in prompt order: the expected score
+    under the model's distribution (see score_decoding.expected_score), or the generated text if it has no number.
+    The records are written to logprobs_file, one per prompt row with its row index, replacing the file of an earlier run,
+    so that expected_scores(load_logprobs(logprobs_file)) lines up with the rows of the output file.
+    '''
+    texts = []
+    with open(logprobs_file, "w", encoding="utf-8") as f:
+        for row, value in enumerate(generated):
+            # the rows left out of generation have no record
+            record = json.loads(value) if value else {"text": "", "tokens": [], "logprobs": []}
+            record["row"] = row
+            record["expected"] = expected_score(record)
+            texts.append(record["text"] if math.isnan(record["expected"]) else "%.4f" % record["expected"])
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return texts
+
+
+def partial_settings(settings):
+    '''the settings as they read back from the header of a partial file, e.g. tuples become lists'''
+    return json.loads(json.dumps(settings, sort_keys=True))
+
+
+def load_partial(partial_file, prompts=None, settings=None):
+    '''
+    Read the rows already generated into a partial output file, as two dicts of prompt row index -> generated text
+    and prompt row index -> generated tokens (None if the generate function did not return them).
+    A last line torn by a crash is cut off the file so that new chunks are appended after complete lines.
+    The file is only resumed if it was written with the same settings and every saved row has the same prompt as prompts,
+    otherwise a ValueError is raised instead of mixing outputs of different prompt files or sampling params.
+    '''
+    if not os.path.exists(partial_file):
+        return {}, {}
+    with open(partial_file, "rb+") as f:
+        content = f.read()
+        # only complete lines are parsed, a torn line may end inside a repr or a multi-byte character
+        content = content[:content.rfind(b"\n") + 1]
+        if content.count(b"\n") < 2:
+            # the header itself is torn, nothing was generated yet
+            content = b""
+        f.truncate(len(content))
+    if not content:
+        return {}, {}
+    lines = content.decode("utf-8").split("\n")
+    saved_settings = json.loads(lines[0][len("# settings: "):]) if lines[0].startswith("# settings: ") else None
+    if saved_settings != partial_settings(settings):
+        raise ValueError("%s was generated with other settings (%s, now %s), remove it to start over!" % (partial_file, saved_settings, partial_settings(settings)))
+    done, tokens = {}, {}
+    for line in lines[2:]:
+        fields = line.split("\t")
+        if len(fields) == 4:
+            idx = int(fields[0])
+            if prompts is not None and (idx >= len(prompts) or ast.literal_eval(fields[1]) != prompts[idx]):
+                raise ValueError("Row %d of %s was generated from another prompt, remove it to start over!" % (idx, partial_file))
+            done[idx] = ast.literal_eval(fields[2])
+            tokens[idx] = int(fields[3]) if fields[3] else None
+    return done, tokens
+
+
+def open_partial(partial_file, settings=None):
+    '''open a partial output file to append to, writing its header with the settings of the run if it is new'''
+    f = open(partial_file, "a", encoding="utf-8")
+    if f.tell() == 0:
+        f.write("# settings: %s\nidx\tprompt\tvllm_output\tcompletion_tokens\n" % json.dumps(partial_settings(settings), sort_keys=True))
+    return f
+
+
+def append_partial(f, rows, prompts, generated, tokens):
+    '''append the generated texts and tokens of rows and make sure they are on disk before the next chunk starts'''
+    f.write("".join(f"{i}\t{prompts[i]!r}\t{generated_text!r}\t{'' if n is None else n}\n" for i, generated_text, n in zip(rows, generated, tokens)))
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def run_chunked(prompts, generate, output_file, chunk_size=512, order=None, keep=None, prompt_file=None, prompt_tokens=None, metadata=None, warmup=0, settings=None, postprocess=None):
+    '''
+    Generate the outputs chunk by chunk and stream each finished chunk to output_file + ".partial", keyed by the prompt row index.
+    Rows already in the partial file are skipped, so a crashed run resumes where it stopped.
+    When every row is done, output_file is written in prompt order and the partial file is removed.
+    generate: a function from a list of prompts to a list of generated texts, e.g. a stub, or to the texts and the number of tokens
+    generated for each, e.g. vllm_generator(llm, sampling_params); the tokens are saved as completion_tokens in Parquet
+    order: the order to submit the prompts in, default is the file order
+    keep: a boolean mask of the prompts to send to the model, the output of the others is left empty
+    warmup: the number of prompts generated on their own before the first chunk, so that with prefix caching
+    the prefix they share with the rest is already cached when the first chunk is prefilled
+    prompt_file, prompt_tokens, metadata: saved with the outputs when output_file is Parquet, see write_outputs
+    settings: the model and sampling settings of the run, a partial file written with other settings is not resumed
+    postprocess: a function from the generated values of every row, in prompt order, to the outputs written, e.g. expected_score_outputs
+    '''
+    partial_file = output_file + ".partial"
+    done, tokens = load_partial(partial_file, prompts, settings)
+    gen_time = [None] * len(prompts)
+    todo = [i for i in (order if order is not None else range(len(prompts))) if i not in done and (keep is None or keep[i])]
+    if done:
+        print("Resuming: %d rows already generated, %d to go." % (len(done), len(todo)))
+
+    with open_partial(partial_file, settings) as f:
+        chunks = [todo[:warmup]] + [todo[start:start + chunk_size] for start in range(warmup, len(todo), chunk_size)]
+        for chunk in chunks:
+            if not chunk:
+                continue
+            begin = time.perf_counter()
+            with stage("generate", rows=len(chunk)):
+                generated, generated_tokens = split_generated(generate([prompts[i] for i in chunk]))
+            for i in chunk:
+                gen_time[i] = (time.perf_counter() - begin) / len(chunk)
+            append_partial(f, chunk, prompts, generated, generated_tokens)
+            done.update(zip(chunk, generated))
+            tokens.update(zip(chunk, generated_tokens))
+
+    generated = [done.get(i, "") for i in range(len(prompts))]
+    if postprocess:
+        generated = postprocess(generated)
+    # rows left out of generation have no tokens, the column is only written if the generate function counted them
+    completion = [tokens.get(i, 0 if i not in done else None) for i in range(len(prompts))]
+    write_outputs(output_file, prompts, generated, prompt_file=prompt_file, metadata=metadata, prompt_tokens=prompt_tokens,
+                  completion_tokens=completion if any(n is not None for n in tokens.values()) else None, gen_time=gen_time)
+    os.remove(partial_file)
+    return generated
+
+
+def run_cot_pipeline(template, generate, output_file1, output_file2, chunk_size=512, keep=None, settings=None):
+    '''
+    Run both prompts of Template 7 with one loaded model. The first prompts go in chunks, and the second prompts of a chunk
+    are built from its outputs in memory and sent in the same generate call as the first prompts of the next chunk,
+    so the two stages overlap instead of running one after the other over the whole data.
+    The outputs of both stages are streamed to partial files as in run_chunked, so a crashed run resumes where it stopped,
+    including the second prompts of rows whose first output was saved.
+    template: a VllmTemplate of the main file with the format of the model
+    output_file1: where the outputs of the first prompt are saved for auditing
+    output_file2: where the outputs of the second prompt, i.e. the scores, are saved
+    keep: a boolean mask of the first prompts to send to the model, the outputs of the others are left empty
+    settings: the model and sampling settings of the run, partial files written with other settings are not resumed
+    '''
+    prompts1 = template.generate_templates(["7p1"], save=False)["7p1"]
+    partial_file1, partial_file2 = output_file1 + ".partial", output_file2 + ".partial"
+    done1, tokens1 = load_partial(partial_file1, prompts1, settings)
+    prompts2 = [""] * len(prompts1)
+    resumed = sorted(done1)
+    for i, prompt in zip(resumed, template.cot_prompt2([done1[i] for i in resumed])):
+        prompts2[i] = prompt
+    done2, tokens2 = load_partial(partial_file2, prompts2, settings)
+    if done1:
+        print("Resuming: %d first and %d second CoT outputs already generated." % (len(done1), len(done2)))
+
+    todo = [i for i in range(len(prompts1)) if i not in done1 and (keep is None or keep[i])]
+    chunks = [todo[start:start + chunk_size] for start in range(0, len(todo), chunk_size)]
+    ready = [i for i in resumed if i not in done2]  # rows whose second prompt is built but not yet sent
+    with open_partial(partial_file1, settings) as f1, open_partial(partial_file2, settings) as f2:
+        for chunk in chunks + [[]]:
+            if not chunk and not ready:
+                continue
+            with stage("generate", rows=len(chunk) + len(ready)):
+                generated, generated_tokens = split_generated(generate([prompts1[i] for i in chunk] + [prompts2[i] for i in ready]))
+            append_partial(f1, chunk, prompts1, generated[:len(chunk)], generated_tokens[:len(chunk)])
+            append_partial(f2, ready, prompts2, generated[len(chunk):], generated_tokens[len(chunk):])
+            done1.update(zip(chunk, generated[:len(chunk)]))
+            done2.update(zip(ready, generated[len(chunk):]))
+            tokens1.update(zip(chunk, generated_tokens[:len(chunk)]))
+            tokens2.update(zip(ready, generated_tokens[len(chunk):]))
+            for i, prompt in zip(chunk, template.cot_prompt2(generated[:len(chunk)])):
+                prompts2[i] = prompt
+            ready = chunk
+
+    generated2 = [done2.get(i, "") for i in range(len(prompts1))]
+    for output_file, prompts, done, tokens in ((output_file1, prompts1, done1, tokens1), (output_file2, prompts2, done2, tokens2)):
+        completion = [tokens.get(i, 0 if i not in done else None) for i in range(len(prompts))]
+        write_outputs(output_file, prompts, [done.get(i, "") for i in range(len(prompts))], completion_tokens=completion if any(n is not None for n in tokens.values()) else None)
+    os.remove(partial_file1)
+    os.remove(partial_file2)
+    return generated2
+
+
+def main(max_model_len=1024, gpu_memory_util=0.9, quantization=None, temperature=0.8, top_p=0.95, max_tokens=512, overflow="drop", sort_by_length=True, chunk_size=512, seed=0, use_cache=True, output_format="tsv", score_only=False, score_max_tokens=8, score_logprobs=0, prefix_caching=True, layout="default", samples=1, first_samples=None, agreement=0.0, base_url=None, max_in_flight=64):
+    '''
+    overflow: what to do with prompts longer than max_model_len, "drop" (their output is left empty), "error" (raised before the model is loaded)
+    or "warn" (sent anyway, only for a base_url server that truncates them, vLLM rejects them)
+    sort_by_length: submit the prompts sorted by token length so batches are denser, the outputs are written in the original order
+    chunk_size: the number of prompts generated before they are saved, a rerun after a crash skips the saved rows
+    template = "07" runs both CoT prompts with run_cot_pipeline instead of reading a prompt file
+    output_format: "tsv" or "parquet", which stores prompt IDs instead of prompts, with token counts and timing
+    use_cache: answer prompts already generated with the same model, quantization, sampling params and seed from ./.cache/responses.sqlite
+    score_only: greedy decoding stopped at the end of the line with score_max_tokens tokens, for templates that ask for the score alone
+    score_logprobs: in the score-only mode, keep this many top logprobs per step and output the expected score instead of the sampled one,
+    the logprobs are saved next to the outputs in a .logprobs.jsonl file
+    prefix_caching: let vLLM reuse the prefill of the text shared by the prompts, the first prompt is sent alone to warm the cache
+    layout: the prompt layout of template "07", "prefix" puts the instruction of the second prompt before the analysis
+    samples: the number of completions per prompt for self-consistency, sampled in one generate call so they share the prefill,
+    each output is then the list of its completions, aggregated by output_parser.aggregate_scores
+    first_samples: sample this many completions first (at least 2), and the rest only for the prompts whose first scores differ by more than agreement
+    base_url: send the prompts to an OpenAI-compatible server already serving model_name (e.g. vllm serve) instead of loading it,
+    with at most max_in_flight requests waiting at once
+    The timings of every stage, the token counts and the peak memory of the run are saved to <output file>.metrics.json.
+    '''
+    metrics.reset()
+    if score_only:
+        sampling = score_sampling_kwargs(max_tokens=score_max_tokens, logprobs=score_logprobs)
+    else:
+        sampling = {"temperature": temperature, "top_p": top_p, "max_tokens": max_tokens}
+    if samples > 1:
+        if score_only or template == "07":
+            raise ValueError("Self-consistency needs sampled completions of a prompt file, it cannot be combined with the score-only mode or template 07.")
+        if first_samples is not None and first_samples < 2:
+            # a single score always agrees with itself, so no prompt would get its remaining samples
+            raise ValueError("first_samples must be at least 2 for the first scores to be compared, or None to sample every completion at once.")
+        first_samples = first_samples if first_samples and first_samples < samples else samples
+    if base_url and (score_logprobs or samples > 1):
+        raise ValueError("The server backend returns one text per prompt, it cannot be combined with score_logprobs or samples.")
+    cache = ResponseCache() if use_cache else None
+    info = {"model_name": model_name, "template": template, "lang_pair": lang_pair, "quantization": quantization, "seed": seed, **sampling}
+
+    def finish(output_file):
+        if cache:
+            print("Response cache:", cache.stats())
+            count("cache_hits", cache.hits)
+            count("cache_misses", cache.misses)
+        metrics_file = metrics.save(os.path.splitext(output_file)[0] + ".metrics.json", **info)
+        report = metrics.report()
+        print("Stages:", {name: "%.2fs" % timing["seconds"] for name, timing in report["stages"].items()}, "peak RSS: %s MB" % report["peak_rss_mb"])
+        print("Metrics saved to %s" % metrics_file)
+        print("Done!")
+
+    def load_generator():
+        if base_url:
+            backend = OpenAIBackend(base_url, max_in_flight=max_in_flight, seed=seed, sampling=sampling)
+            backend.load(model_name)
+
+            def generate(prompts):
+                texts, token_counts = backend.generate(prompts)
+                count("completion_tokens", sum(token_counts))
+                return texts, token_counts
+            if cache:
+                generate = cached_generator(generate, cache, model=model_name, quantization=quantization, sampling=sampling, seed=seed, with_tokens=True)
+            return generate
+        from vllm import LLM, SamplingParams
+        with stage("load"):
+            llm = LLM(model=model_name, gpu_memory_utilization=gpu_memory_util, max_model_len=max_model_len, dtype="auto", quantization=quantization, seed=seed, enable_prefix_caching=prefix_caching)
+        if score_only:
+            generate = vllm_score_generator(llm, SamplingParams(seed=seed, **sampling))
+        elif samples > 1:
+            def sample_generator(n, round_seed):
+                generate = vllm_samples_generator(llm, SamplingParams(n=n, seed=round_seed, **sampling))
+                if cache:
+                    generate = cached_generator(generate, cache, model=model_name, quantization=quantization, sampling={**sampling, "n": n}, seed=round_seed, samples=True, with_tokens=True)
+                return generate
+            if first_samples == samples:
+                return sample_generator(samples, seed)
+            # the second round has its own seed, otherwise it would repeat the completions of the first
+            return self_consistent_generator(sample_generator(first_samples, seed), sample_generator(samples - first_samples, seed + 1), agreement)
+        else:
+            generate = vllm_generator(llm, SamplingParams(seed=seed, **sampling))
+        if cache:
+            # with logprobs the cached values are records rather than texts
+            generate = cached_generator(generate, cache, model=model_name, quantization=quantization, sampling={**sampling, "records": True} if score_logprobs else sampling, seed=seed, with_tokens=True)
+        return generate
+
+    if template == "07":
+        if score_only:
+            raise ValueError("The score-only mode would cut off the analysis of the first CoT prompt, run 7p2 from its prompt file instead.")
+        # the two prompts of CoT run as one pipeline from the raw data, e.g. ./prompts/llama/ -> llama_format
+        cot_template = VllmTemplate("./raw_data/" + lang_pair + "/" + lang_pair + "_overlaps_test.tsv", format=model_formats[model_type.rstrip("/").split("/")[-1]], layout=layout)
+        prompts1 = cot_template.generate_templates(["7p1"], save=False)["7p1"]
+        # pre-flight of the first prompts, the second ones only exist once the first are answered
+        with stage("preflight", rows=len(prompts1)):
+            lengths = prompt_lengths(prompts1, model_name)
+        print(describe_lengths(lengths, max_model_len, sampling["max_tokens"]))
+        keep = fit_to_context(lengths, max_model_len, sampling["max_tokens"], overflow)
+        count("prompts", keep.sum())
+        count("prompt_tokens", lengths[keep].sum())
+        output_file1 = output_file_name(lang_pair, "7p1", model_name, output_format)
+        output_file2 = output_file_name(lang_pair, "7p2", model_name, output_format)
+        load_partial(output_file1 + ".partial", prompts1, info)
+        run_cot_pipeline(cot_template, load_generator(), output_file1, output_file2, chunk_size=chunk_size, keep=keep, settings=info)
+        finish(output_file2)
+        return
+
+    prompt_file = model_type + lang_pair + "_vllm_t" + template + ".tsv"
+    data = pd.read_csv(prompt_file, encoding="utf-8", sep="\t")
+    prompts = data["final_prompt"].tolist()
+
+    # pre-flight: check the prompt lengths before loading the model
+    with stage("preflight", rows=len(prompts)):
+        lengths = token_lengths(prompt_file, model_name)
+    print(describe_lengths(lengths, max_model_len, sampling["max_tokens"]))
+    keep = fit_to_context(lengths, max_model_len, sampling["max_tokens"], overflow)
+    count("prompts", keep.sum())
+    count("prompt_tokens", lengths[keep].sum())
+    order = length_order(lengths) if sort_by_length else None
+
+    output_file = output_file_name(lang_pair, template, model_name, output_format)
+    metadata = dict(info)
+    if samples > 1:
+        metadata.update({"samples": samples, "first_samples": first_samples, "agreement": agreement})
+    # a partial file of other prompts or settings is refused before the model is loaded
+    load_partial(output_file + ".partial", prompts, metadata)
+    postprocess = None
+    if score_only and score_logprobs:
+        logprobs_file = os.path.splitext(output_file)[0] + ".logprobs.jsonl"
+        postprocess = lambda generated: expected_score_outputs(generated, logprobs_file)
+    run_chunked(prompts, load_generator(), output_file, chunk_size=chunk_size, order=order, keep=keep, prompt_file=prompt_file, prompt_tokens=lengths, metadata=metadata, warmup=1 if prefix_caching else 0, settings=metadata, postprocess=postprocess)
+    finish(output_file)
 
 if __name__ == "__main__":
-    main(quantization=quantization)
\ No newline at end of file
+    main(quantization=quantization)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import json
+import math
+import numpy as np
+
+
+def score_sampling_kwargs(max_tokens=8, logprobs=None, stop=("\n",)):
+    '''
+    The SamplingParams of the score-only mode: greedy, stopped at the end of the line, with a budget just large enough for a score.
+    logprobs: the number of top logprobs kept at each step, needed by expected_score
+    '''
+    kwargs = {"temperature": 0.0, "max_tokens": max_tokens, "stop": list(stop)}
+    if logprobs:
+        kwargs["logprobs"] = logprobs
+    return kwargs
+
+
+def step_logprobs(completion):
+    '''
+    The generated tokens and the top logprobs at each step of a vLLM CompletionOutput, as plain lists and dicts of
+    token string -> logprob, which is the form expected_score takes and the form saved as fixtures.
+    '''
+    tokens, steps = [], []
+    for token_id, step in zip(completion.token_ids, completion.logprobs or []):
+        tokens.append(step[token_id].decoded_token if token_id in step else "")
+        steps.append({logprob.decoded_token: logprob.logprob for logprob in step.values()})
+    return {"text": completion.text, "tokens": tokens, "logprobs": steps}
+
+
+def numeric_candidates(step):
+    '''the candidates of a step that are a number once whitespace is stripped, as a dict of value -> probability'''
+    candidates = {}
+    for token, logprob in step.items():
+        stripped = token.strip().lstrip("▁")
+        if stripped.isdigit() and stripped.isascii():
+            candidates[int(stripped)] = candidates.get(int(stripped), 0.0) + math.exp(logprob)
+    return candidates
+
+
+def number_lengths(prefix, low=0, high=100):
+    '''the numbers of digits of the whole numbers in [low, high] written starting with prefix, e.g. {1, 2, 3} for "1" in 0-100'''
+    return {len(str(n)) for n in range(max(math.ceil(low), 0), math.floor(high) + 1) if str(n).startswith(prefix)}
+
+
+def expected_score(record, low=0, high=100):
+    '''
+    The expected score under the model's distribution at the steps where it writes the score, or NaN if it writes no number.
+    record: {"tokens": generated tokens, "logprobs": top logprobs of each step as dicts of token string -> logprob}
+    If the tokenizer has whole numbers as tokens (e.g. "85"), the expectation is taken over the numeric candidates of the first numeric step.
+    If it splits numbers into digits (e.g. Llama 2), the expectation is taken digit by digit along the generated number,
+    weighting each digit position by its place value, as long as every other candidate digit can only continue a number with
+    as many digits as the generated one within [low, high]. Otherwise, e.g. a "1" (for 100) against a generated 95 or an "8" (for 8x)
+    against a generated 5, the digits of the other numbers were never generated and the greedy number is returned instead;
+    on a 0-100 scale that is the usual case.
+    The result is clipped to [low, high].
+    '''
+    tokens, steps = record["tokens"], record["logprobs"]
+    start = next((i for i, token in enumerate(tokens) if token.strip().lstrip("▁").isdigit()), None)
+    if start is None:
+        return float("nan")
+
+    candidates = numeric_candidates(steps[start])
+    if any(value >= 10 for value in candidates):
+        # whole numbers are single tokens
+        total = sum(candidates.values())
+        return float(np.clip(sum(value * p for value, p in candidates.items()) / total, low, high))
+
+    # numbers are split into digits: follow the generated digits
+    generated, digit_steps = "", []
+    for token, step in zip(tokens[start:], steps[start:]):
+        digit = token.strip().lstrip("▁")
+        if not digit.isdigit():
+            break
+        generated += digit
+        digit_steps.append(step)
+    expected = 0.0
+    for position, step in enumerate(digit_steps):
+        digits = {value: p for value, p in numeric_candidates(step).items() if value < 10}
+        if not digits:
+            return float("nan")
+        if any(number_lengths(generated[:position] + str(value), low, high) != {len(generated)} for value in digits if str(value) != generated[position]):
+            return float(np.clip(int(generated), low, high))
+        total = sum(digits.values())
+        expected += 10 ** (len(digit_steps) - 1 - position) * sum(value * p for value, p in digits.items()) / total
+    return float(np.clip(expected, low, high))
+
+
+def expected_scores(records, low=0, high=100):
+    '''the expected score of each record, and a boolean mask of the records with a score'''
+    scores = np.array([expected_score(record, low, high) for record in records], dtype=np.float64)
+    return scores, ~np.isnan(scores)
+
+
+def save_logprobs(file_name, records):
+    '''save the records of step_logprobs to a jsonl file, e.g. as fixtures for expected_score'''
+    with open(file_name, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def load_logprobs(file_name):
+    with open(file_name, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+from scipy.stats import rankdata
+
+
+def pearson_rows(x, y):
+    '''the Pearson correlation of each row of x with the same row of y, for 2-D arrays of shape (resamples, rows)'''
+    x = x - x.mean(axis=-1, keepdims=True)
+    y = y - y.mean(axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (x * y).sum(axis=-1) / np.sqrt((x * x).sum(axis=-1) * (y * y).sum(axis=-1))
+
+
+'''
+the correlations that can be computed on a whole batch of resamples at once, as the transform applied to 
+the scores and labels before a row-wise Pearson correlation: Spearman is Pearson on average ranks, as in scipy
+'''
+metrics = {
+    "spearman": lambda x: rankdata(x, axis=-1),
+    "pearson": lambda x: x,
+}
+
+
+def correlate_rows(x, y, metric="spearman"):
+    '''the correlation of each row of x with the same row of y'''
+    return pearson_rows(metrics[metric](x), metrics[metric](y))
+
+
+def dense_codes(x):
+    '''the values of x as integer codes in sorted order, and the number of distinct values'''
+    values, codes = np.unique(x, return_inverse=True)
+    return codes.reshape(np.shape(x)), len(values)
+
+
+def rank_codes(codes, n_codes):
+    '''
+    The average ranks (as scipy's rankdata) of each row of a 2-D array of dense codes, by counting the codes of each row
+    instead of sorting it, which is much faster for scores and labels with few distinct values.
+    '''
+    n_rows = len(codes)
+    offsets = n_codes * np.arange(n_rows)[:, None]
+    counts = np.bincount((codes + offsets).ravel(), minlength=n_rows * n_codes).reshape(n_rows, n_codes)
+    average = np.cumsum(counts, axis=1) - (counts - 1) / 2
+    return np.take_along_axis(average, codes, axis=1)
+
+
+def align(scores, valid, label):
+    '''
+    Keep the rows where every configuration has a score, so that configurations with different dropped rows are compared on the same rows.
+    scores, valid: lists of the score arrays and validity masks of each configuration, from extract_scores
+    Returns the stacked scores of shape (configurations, rows) and the labels of the kept rows.
+    '''
+    common = np.logical_and.reduce([np.asarray(v, dtype=bool) for v in valid])
+    return np.stack([np.asarray(s, dtype=np.float64)[common] for s in scores]), np.asarray(label, dtype=np.float64)[common]
+
+
+def resample_indices(rng, n_resamples, n_rows):
+    return rng.integers(0, n_rows, size=(n_resamples, n_rows))
+
+
+def bootstrap(scores, label, metric="spearman", n_resamples=1000, batch_size=100, seed=0):
+    '''
+    The correlation of each configuration with the labels on n_resamples bootstrap resamples of the rows,
+    with every configuration evaluated on the same resamples so that their differences are paired.
+    scores: an array of shape (configurations, rows), e.g. from align
+    Returns an array of shape (configurations, n_resamples).
+    '''
+    scores = np.atleast_2d(scores)
+    label = np.asarray(label, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    if metric == "spearman":
+        # resampling only repeats values, so each configuration is ranked from codes computed once
+        codes = [dense_codes(x) for x in scores]
+        label_codes = dense_codes(label)
+        transform = lambda k, idx: rank_codes(codes[k][0][idx], codes[k][1])
+        transform_label = lambda idx: rank_codes(label_codes[0][idx], label_codes[1])
+    else:
+        transform = lambda k, idx: scores[k][idx]
+        transform_label = lambda idx: label[idx]
+    results = np.empty((len(scores), n_resamples))
+    for start in range(0, n_resamples, batch_size):
+        idx = resample_indices(rng, min(batch_size, n_resamples - start), len(label))
+        # the labels of a batch are transformed once for all configurations
+        resampled_label = transform_label(idx)
+        for k in range(len(scores)):
+            results[k, start:start + len(idx)] = pearson_rows(transform(k, idx), resampled_label)
+    return results
+
+
+def bootstrap_ci(num, label, metric="spearman", n_resamples=1000, alpha=0.05, seed=0):
+    '''the correlation of one configuration and its percentile bootstrap confidence interval, as (estimate, low, high)'''
+    num = np.asarray(num, dtype=np.float64)
+    label = np.asarray(label, dtype=np.float64)
+    estimate = correlate_rows(num[None], label[None], metric)[0]
+    samples = bootstrap(num[None], label, metric, n_resamples, seed=seed)[0]
+    low, high = np.nanpercentile(samples, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+    return estimate, low, high
+
+
+def permutation_test(num_a, num_b, label, metric="spearman", n_permutations=1000, batch_size=100, seed=0):
+    '''
+    Paired permutation test of the difference in correlation between two configurations on the same rows:
+    each permutation swaps the two scores of a random half of the rows.
+    Returns the observed difference (a - b) and its two-sided p-value.
+    '''
+    num_a = np.asarray(num_a, dtype=np.float64)
+    num_b = np.asarray(num_b, dtype=np.float64)
+    label = np.asarray(label, dtype=np.float64)
+    observed = correlate_rows(num_a[None], label[None], metric)[0] - correlate_rows(num_b[None], label[None], metric)[0]
+    # the labels are the same in every permutation
+    label = metrics[metric](label)[None]
+    if metric == "spearman":
+        # the permuted scores only take values of a or b, so they are ranked from codes computed once
+        (codes_a, codes_b), n_codes = dense_codes(np.stack([num_a, num_b]))
+        transform = lambda swap, first, second: rank_codes(np.where(swap, second, first), n_codes)
+    else:
+        codes_a, codes_b = num_a, num_b
+        transform = lambda swap, first, second: np.where(swap, second, first)
+    rng = np.random.default_rng(seed)
+    extreme = 0
+    for start in range(0, n_permutations, batch_size):
+        swap = rng.random((min(batch_size, n_permutations - start), len(num_a))) < 0.5
+        deltas = pearson_rows(transform(swap, codes_a, codes_b), label) - pearson_rows(transform(swap, codes_b, codes_a), label)
+        extreme += int((np.abs(deltas) >= abs(observed) - 1e-12).sum())
+    return observed, (extreme + 1) / (n_permutations + 1)
+
+
+def compare_configurations(results, label, metric="spearman", reference=None, n_resamples=1000, alpha=0.05, seed=0):
+    '''
+    Compare many template/model configurations on the same labels.
+    results: a dict of configuration name -> (scores, valid) from extract_scores
+    reference: the configuration the others are tested against, default is the one with the highest correlation
+    Returns a dataframe with the correlation of each configuration, its bootstrap confidence interval,
+    the paired bootstrap difference to the reference with its confidence interval and two-sided p-value,
+    all on the rows where every configuration has a score.
+    '''
+    names = list(results)
+    scores, kept_label = align([results[name][0] for name in names], [results[name][1] for name in names], label)
+    estimates = correlate_rows(scores, kept_label[None], metric)
+    samples = bootstrap(scores, kept_label, metric, n_resamples, seed=seed)
+    ref = names.index(reference) if reference else int(np.nanargmax(estimates))
+    deltas = samples - samples[ref]
+    low, high = 100 * alpha / 2, 100 * (1 - alpha / 2)
+    with np.errstate(invalid="ignore"):
+        p_values = np.minimum(1.0, 2 * np.minimum((deltas <= 0).mean(axis=1), (deltas >= 0).mean(axis=1)))
+    p_values[ref] = 1.0
+    return pd.DataFrame({
+        metric: estimates.round(4),
+        "ci_low": np.nanpercentile(samples, low, axis=1).round(4),
+        "ci_high": np.nanpercentile(samples, high, axis=1).round(4),
+        "delta": (estimates - estimates[ref]).round(4),
+        "delta_ci_low": np.nanpercentile(deltas, low, axis=1).round(4),
+        "delta_ci_high": np.nanpercentile(deltas, high, axis=1).round(4),
+        "p_value": p_values.round(4),
+        "rows": len(kept_label),
+    }, index=pd.Index(names, name="configuration"))
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import zlib
+import argparse
+import pandas as pd
+from run import output_file_name, run_chunked
+from preflight import token_lengths, count_tokens, read_prompts, fit_to_context, length_order
+from response_cache import ResponseCache, cached_generator
+from openai_client import OpenAIBackend
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run a grid of models x templates x language pairs, loading each model once")
+    parser.add_argument("--models", type=str, nargs="+", required=True, help="model_name:prompt_folder[:quantization], e.g. meta-llama/Llama-2-7b-chat-hf:llama TheBloke/Mixtral-8x7B-Instruct-v0.1-AWQ:mixtral:awq")
+    parser.add_argument("--templates", type=str, nargs="+", required=True, help="The templates to run, e.g. 01 03 08")
+    parser.add_argument("--lang_pairs", type=str, nargs="+", default=["en-de", "en-mr", "en-zh", "et-en", "ne-en", "ro-en", "ru-en", "si-en"], help="The language pairs to run")
+    parser.add_argument("--prompt_dir", type=str, default="./prompts/", help="The folder containing the prompts of each model")
+    parser.add_argument("--output_dir", type=str, default=".", help="The folder to save the outputs and sweep_status.json")
+    parser.add_argument("--backend", type=str, default="vllm", choices=["vllm", "openai", "fake"], help="openai sends the prompts to a running OpenAI-compatible server at --base_url, fake runs the scheduler offline without a model")
+    parser.add_argument("--base_url", type=str, default="http://localhost:8000/v1", help="The endpoint of the openai backend, e.g. of vllm serve")
+    parser.add_argument("--max_in_flight", type=int, default=64, help="The maximum number of requests the openai backend has waiting at once")
+    parser.add_argument("--output_format", type=str, default="tsv", choices=["tsv", "parquet"], help="parquet stores prompt IDs, token counts and timing instead of the prompts")
+    parser.add_argument("--chunk_size", type=int, default=2048, help="The number of prompts per generate call, each chunk is saved to the partial file of its job")
+    parser.add_argument("--max_model_len", type=int, default=1024)
+    parser.add_argument("--max_tokens", type=int, default=512)
+    parser.add_argument("--temperature", type=float, default=0.8)
+    parser.add_argument("--top_p", type=float, default=0.95)
+    parser.add_argument("--gpu_memory_util", type=float, default=0.9)
+    parser.add_argument("--overflow", type=str, default="drop", choices=["drop", "error", "warn"], help="What to do with prompts longer than max_model_len, see preflight.fit_to_context")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no_cache", action="store_true", help="Do not answer prompts from the response cache shared with run.py")
+    args = parser.parse_args()
+    return args
+
+
+class VllmBackend:
+    '''runs the prompts with an in-process vLLM engine, one model at a time'''
+    def __init__(self, max_model_len=1024, gpu_memory_util=0.9, temperature=0.8, top_p=0.95, max_tokens=512, seed=0, **kwargs) -> None:
+        # the prompts of a job share their instruction and are run one job after the other, so their prefill is reused
+        self.llm_kwargs = {"max_model_len": max_model_len, "gpu_memory_utilization": gpu_memory_util, "dtype": "auto", "enable_prefix_caching": True, "seed": seed}
+        self.sampling_kwargs = {"temperature": temperature, "top_p": top_p, "max_tokens": max_tokens, "seed": seed}
+        self.llm = None
+
+    def load(self, model_name, quantization=None):
+        from vllm import LLM, SamplingParams
+        self.llm = LLM(model=model_name, quantization=quantization, **self.llm_kwargs)
+        self.sampling_params = SamplingParams(**self.sampling_kwargs)
+
+    def generate(self, prompts):
+        '''the generated text and the number of generated tokens of each prompt'''
+        outputs = self.llm.generate(prompts, self.sampling_params, use_tqdm=False)
+        return [output.outputs[0].text for output in outputs], [len(output.outputs[0].token_ids) for output in outputs]
+
+    def unload(self):
+        import gc
+        import torch
+        self.llm = None
+        gc.collect()
+        torch.cuda.empty_cache()
+
+
+class FakeBackend:
+    '''
+    answers every prompt with a score derived from its hash, for running the scheduler offline;
+    its prompts are counted in whitespace tokens, so no tokenizer has to be downloaded
+    '''
+    def __init__(self, **kwargs) -> None:
+        self.model_name = None
+        self.loads = []
+
+    @staticmethod
+    def tokenizer(prompts):
+        return {"input_ids": [prompt.split() for prompt in prompts]}
+
+    def load(self, model_name, quantization=None):
+        self.model_name = model_name
+        self.loads.append(model_name)
+
+    def generate(self, prompts):
+        texts = ["Score: %d" % (zlib.crc32(prompt.encode("utf-8")) % 101) for prompt in prompts]
+        return texts, [len(text.split()) for text in texts]
+
+    def unload(self):
+        self.model_name = None
+
+
+backends = {"vllm": VllmBackend, "openai": OpenAIBackend, "fake": FakeBackend}
+
+
+def parse_model(spec):
+    '''model_name:prompt_folder[:quantization] -> (model_name, prompt_folder, quantization)'''
+    fields = spec.split(":")
+    return fields[0], fields[1], fields[2] if len(fields) > 2 else None
+
+
+def make_jobs(models, templates, lang_pairs, prompt_dir="./prompts/", output_dir=".", output_format="tsv"):
+    '''one job per model x template x language pair, grouped by model in the order given'''
+    jobs = []
+    for model_name, prompt_folder, quantization in models:
+        for template in templates:
+            for lang_pair in lang_pairs:
+                jobs.append({
+                    "model_name": model_name,
+                    "quantization": quantization,
+                    "template": template,
+                    "lang_pair": lang_pair,
+                    "prompt_file": os.path.join(prompt_dir, prompt_folder, lang_pair + "_vllm_t" + template + ".tsv"),
+                    "output_file": os.path.join(output_dir, output_file_name(lang_pair, template, model_name, output_format)),
+                    "status": "pending",
+                    "rows": 0,
+                    "wall_time": 0.0,
+                    "completion_tokens": 0,
+                    "tokens_per_sec": 0.0,
+                })
+    return jobs
+
+
+def save_status(jobs, status_file):
+    if status_file:
+        with open(status_file, "w", encoding="utf-8") as f:
+            json.dump(jobs, f, indent=2)
+
+
+def preflight_lengths(backend, job):
+    '''the token lengths of the prompts of a job, with the backend's own tokenizer if it has one, e.g. the fake backend'''
+    if getattr(backend, "tokenizer", None):
+        return count_tokens(read_prompts(job["prompt_file"]), backend.tokenizer)
+    return token_lengths(job["prompt_file"], job["model_name"])
+
+
+def run_model(backend, model_jobs, lengths, keeps, chunk_size=2048, status_file=None, jobs=None, cache=None, sampling=None, seed=0):
+    '''
+    Run every job of one loaded model, one after the other, through run_chunked as run.py does: the prompts that fit
+    the context are submitted sorted by length, each chunk is saved to the partial file of its job so that a crashed sweep resumes
+    where it stopped, and the answers are taken from and added to the response cache shared with run.py.
+    lengths, keeps: the token lengths and the mask of the prompts to send of each job, from the pre-flight
+    sampling, seed: the sampling params of the backend, which key the cache and the partial files
+    '''
+    for job, job_lengths in zip(model_jobs, lengths):
+        job["rows"] = len(job_lengths)
+    for job, job_lengths, keep in zip(model_jobs, lengths, keeps):
+        job["status"] = "running"
+        save_status(jobs, status_file)
+
+        def generate(prompts):
+            texts, token_counts = backend.generate(prompts)
+            job["completion_tokens"] += sum(token_counts)
+            return texts, token_counts
+        if cache is not None:
+            generate = cached_generator(generate, cache, model=job["model_name"], quantization=job["quantization"], sampling=sampling, seed=seed, with_tokens=True)
+
+        # the settings of run.py for the same job, so that either can resume the partial file of the other
+        metadata = {"model_name": job["model_name"], "template": job["template"], "lang_pair": job["lang_pair"], "quantization": job["quantization"], "seed": seed, **(sampling or {})}
+        begin = time.perf_counter()
+        run_chunked(read_prompts(job["prompt_file"]), generate, job["output_file"], chunk_size=chunk_size, order=length_order(job_lengths), keep=keep,
+                    prompt_file=job["prompt_file"], prompt_tokens=job_lengths, metadata=metadata, settings=metadata)
+        job["wall_time"] = round(time.perf_counter() - begin, 3)
+        job["tokens_per_sec"] = round(job["completion_tokens"] / job["wall_time"], 2) if job["wall_time"] else 0.0
+        job["status"] = "done"
+    save_status(jobs, status_file)
+
+
+def run_sweep(jobs, backend, chunk_size=2048, status_file=None, cache=None, sampling=None, seed=0, max_model_len=1024, overflow="drop"):
+    '''
+    Run the jobs, loading each model once for all of its templates and language pairs.
+    Before a model is loaded, the prompts of its jobs are checked against max_model_len and handled by overflow, see preflight.fit_to_context.
+    Jobs whose output file already exists are skipped, and a model that fails marks its unfinished jobs as failed without stopping the sweep.
+    cache: a ResponseCache shared with run.py, None to always generate
+    sampling, seed: the sampling params the backend was created with
+    '''
+    max_tokens = (sampling or {}).get("max_tokens", 512)
+    for job in jobs:
+        if os.path.exists(job["output_file"]):
+            job["status"] = "skipped"
+        elif not os.path.exists(job["prompt_file"]):
+            job["status"] = "missing"
+
+    models = []
+    for job in jobs:
+        if (job["model_name"], job["quantization"]) not in models:
+            models.append((job["model_name"], job["quantization"]))
+
+    for model_name, quantization in models:
+        model_jobs = [job for job in jobs if job["model_name"] == model_name and job["quantization"] == quantization and job["status"] == "pending"]
+        if not model_jobs:
+            continue
+        print("Loading %s for %d jobs" % (model_name, len(model_jobs)))
+        try:
+            lengths = [preflight_lengths(backend, job) for job in model_jobs]
+            keeps = [fit_to_context(job_lengths, max_model_len, max_tokens, overflow) for job_lengths in lengths]
+            backend.load(model_name, quantization=quantization)
+            run_model(backend, model_jobs, lengths, keeps, chunk_size=chunk_size, status_file=status_file, jobs=jobs, cache=cache, sampling=sampling, seed=seed)
+        except Exception as e:
+            print("%s failed: %s" % (model_name, e))
+            for job in model_jobs:
+                if job["status"] != "done":
+                    job["status"] = "failed"
+            save_status(jobs, status_file)
+        finally:
+            backend.unload()
+
+    save_status(jobs, status_file)
+    return jobs
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    models = [parse_model(spec) for spec in args.models]
+    jobs = make_jobs(models, args.templates, args.lang_pairs, args.prompt_dir, args.output_dir, args.output_format)
+    sampling = {"temperature": args.temperature, "top_p": args.top_p, "max_tokens": args.max_tokens}
+    backend = backends[args.backend](max_model_len=args.max_model_len, gpu_memory_util=args.gpu_memory_util, seed=args.seed, base_url=args.base_url, max_in_flight=args.max_in_flight, **sampling)
+    # the fake answers must not be cached as the answers of the real models
+    cache = ResponseCache() if args.backend != "fake" and not args.no_cache else None
+    run_sweep(jobs, backend, chunk_size=args.chunk_size, status_file=os.path.join(args.output_dir, "sweep_status.json"), cache=cache, sampling=sampling, seed=args.seed,
+              max_model_len=args.max_model_len, overflow=args.overflow)
+    if cache:
+        print("Response cache:", cache.stats())
+    print(pd.DataFrame(jobs)[["model_name", "template", "lang_pair", "status", "rows", "wall_time", "tokens_per_sec"]].to_string(index=False))